@@ -26,6 +26,9 @@ create table blogs(
     `name` varchar(50) not null,
     `summary` varchar(200) not null,
     `content` mediumtext not null,
+    `html_content` mediumtext,
+    `comment_count` int not null default 0,
+    `last_comment_at` real,
     `created_at` real not null,
     key `idx_created_at` (`created_at`),
     primary key (`id`)
@@ -38,9 +41,17 @@ create table comments(
     `user_image` varchar(500),
     `blog_id` varchar(50) not null,
     `content` mediumtext not null,
+    `html_content` mediumtext,
     `created_at` real not null,
     key `idx_created_at` (`created_at`),
+    key `idx_blog_id_created_at` (`blog_id`, `created_at`),
     primary key (`id`)
 )engine=innodb default charset=utf8;
 
-
+-- 已有数据库升级：
+-- alter table blogs add `html_content` mediumtext after `content`;
+-- alter table comments add `html_content` mediumtext after `content`;
+-- alter table blogs add `comment_count` int not null default 0 after `html_content`, add `last_comment_at` real after `comment_count`;
+-- alter table comments add key `idx_blog_id_created_at` (`blog_id`, `created_at`);
+-- update blogs set `comment_count`=(select count(*) from comments where comments.`blog_id`=blogs.`id`),
+--     `last_comment_at`=(select max(`created_at`) from comments where comments.`blog_id`=blogs.`id`);
@@ -1,3 +1,5 @@
+import json, math, base64
+
 
 class Page(object):
     def __init__(self, item_count, page_index=1, page_size=8):
@@ -21,6 +23,79 @@ class Page(object):
     __repr__ = __str__
 
 
+def encode_cursor(direction, item):
+    s = json.dumps([direction, item['created_at'], item['id']], separators=(',', ':'))
+    return base64.urlsafe_b64encode(s.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor):
+    try:
+        s = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode('utf-8')
+        direction, created_at, pk = json.loads(s)
+    except (ValueError, TypeError):
+        raise APIValueError('cursor', 'invalid cursor')
+    if direction not in ('next', 'prev'):
+        raise APIValueError('cursor', 'invalid cursor')
+    if isinstance(created_at, bool) or not isinstance(created_at, (int, float)) or not isinstance(pk, str):
+        raise APIValueError('cursor', 'invalid cursor')
+    # json.loads接受NaN和Infinity，传给数据库会变成无效的sql
+    if not math.isfinite(created_at):
+        raise APIValueError('cursor', 'invalid cursor')
+    return direction, (created_at, pk)
+
+
+class CursorPage(object):
+    # 基于(created_at, id)游标的分页，翻页代价与页码深度无关
+    def __init__(self, cursor=None, page_size=8):
+        self.page_size = page_size
+        self.cursor = cursor or None
+        self.next_cursor = None
+        self.prev_cursor = None
+        self.has_next = False
+        self.has_previous = False
+        if self.cursor:
+            self._direction, self._position = decode_cursor(self.cursor)
+        else:
+            self._direction, self._position = 'next', None
+        # 多取一条用于判断是否还有下一页，不输出给客户端
+        self._limit = page_size + 1
+
+    @property
+    def limit(self):
+        return self._limit
+
+    @property
+    def seek(self):
+        if self._position is None:
+            return dict(orderBy='created_at desc, id desc')
+        if self._direction == 'next':
+            return dict(after=self._position)
+        return dict(before=self._position)
+
+    def paginate(self, items):
+        items = list(items)
+        more = len(items) > self.page_size
+        if self._direction == 'next':
+            items = items[:self.page_size]
+            self.has_next = more
+            self.has_previous = self._position is not None
+        else:
+            items = items[-self.page_size:] if more else items
+            self.has_next = True
+            self.has_previous = more
+        if items:
+            if self.has_next:
+                self.next_cursor = encode_cursor('next', items[-1])
+            if self.has_previous:
+                self.prev_cursor = encode_cursor('prev', items[0])
+        return items
+
+    def __str__(self):
+        return 'cursor:%s, page_size:%s, next_cursor:%s, prev_cursor:%s' % (self.cursor, self.page_size,
+                                                                           self.next_cursor, self.prev_cursor)
+    __repr__ = __str__
+
+
 class APIError(Exception):
     def __init__(self, error, data='', message=''):
         super(APIError, self).__init__(message)
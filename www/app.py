@@ -1,12 +1,24 @@
 import logging; logging.basicConfig(level=logging.INFO)
-import asyncio, os, time, json
+import asyncio, os, re, time, hashlib, gzip, socket, signal, shutil, tempfile
 from aiohttp import web
-from jinja2 import Environment, FileSystemLoader
+from jinja2 import Environment, FileSystemLoader, FileSystemBytecodeCache
 from datetime import datetime
-from coroweb import add_static, add_routes
-from handlers import cookie2user, COOKIE_NAME
+from coroweb import add_static, add_routes, static_url, precompress_static, brotli, RequestContext
+from handlers import cookie2user, session_generation, COOKIE_NAME
+import orm
 from orm import create_pool
+from cache import LRUCache, page_cache, PageEntry
 from config import configs
+import serializers
+from metrics import Histogram, set_const_labels
+from executors import init_executors, run_stage
+from search import init_search
+
+
+REQUEST_DURATION = Histogram('blog_http_request_duration_seconds', 'Request handling time', ['method', 'status'])
+
+# 匿名访问时可以整页缓存的路径，由configs.cache.pages配置
+app_page_patterns = []
 
 
 def init_jinja2(app, **kw):
@@ -19,90 +31,308 @@ def init_jinja2(app, **kw):
         variable_end_string=kw.get('variable_end_string', '}}'),
         auto_reload=kw.get('auto_reload', True)
     )
+    bytecode_cache = kw.get('bytecode_cache', None)
+    if bytecode_cache:
+        # True时缓存到系统临时目录，也可以指定目录；源文件改变后缓存按校验和自动失效
+        options['bytecode_cache'] = FileSystemBytecodeCache(bytecode_cache if isinstance(bytecode_cache, str) else None)
     path = kw.get('path', None)
     if path is None:
         path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates')
     logging.info('set jinja2 templates path:%s' % path)
     env = Environment(loader=FileSystemLoader(path), **options)
+    env.globals['static_url'] = static_url
     filters = kw.get('filters', None)
     if filters is not None:
         for k, v in filters.items():
             env.filters[k] = v
     app['__templating__'] = env
+    app['__templates__'] = dict()
+    if kw.get('precompile', False):
+        precompile_templates(app)
 
 
-async def logger_factory(app, handler):
-    async def logger(request):
-        logging.info('request:%s %s' % (request.method, request.path))
-        return await handler(request)
-    return logger
+def precompile_templates(app):
+    # 启动时编译全部模版，避免首个请求承担编译开销
+    env = app['__templating__']
+    start = time.perf_counter()
+    names = env.list_templates(extensions=['html'])
+    for name in names:
+        app['__templates__'][name] = env.get_template(name)
+    logging.info('precompiled %s templates in %.1fms' % (len(names), (time.perf_counter() - start) * 1000))
 
 
-async def auth_factory(app, handler):
-    async def auth(request):
-        logging.info('check user:%s, %s' % (request.method, request.path))
-        request.__user__ = None
-        cookie_str = request.cookies.get(COOKIE_NAME)
-        if cookie_str:
-            user = await cookie2user(cookie_str)
-            if user:
-                logging.info('set user:%s' % user.email)
-                request.__user__ = user
-        if request.path.startswith('/manage/') and (request.__user__ is None or not request.__user__.admin):
-            return web.HTTPFound('/signin')
-        return await handler(request)
-    return auth
-
-
-async def data_factory(app, handler):
-    async def parse_data(request):
-        if request.method == 'POST':
-            if request.content_type.startswith('application/json'):
-                request.__data__ = await request.json()
-                logging.info('request json:%s' % request.__data__)
-            elif request.content_type.startswith('application/x-www-form-urlencoded'):
-                request.__data__ = await request.post()
-                logging.info('request form:%s' % request.__data__)
-        return await handler(request)
-    return parse_data
-
-
-async def response_factory(app, handler):
-    async def response(request):
-        logging.info('handle request ...')
-        r = await handler(request)
-        if isinstance(r, web.StreamResponse):
-            return r
-        if isinstance(r, bytes):
-            resp = web.Response(body=r)
+def get_template(app, name):
+    # auto_reload关闭时按名称缓存模版对象，不再经过jinja2的缓存查找和文件修改检查
+    env = app['__templating__']
+    if env.auto_reload:
+        return env.get_template(name)
+    template = app['__templates__'].get(name)
+    if template is None:
+        template = app['__templates__'][name] = env.get_template(name)
+    return template
+
+
+async def authenticate(request, ctx):
+    # 返回None表示继续处理，否则返回跳转响应
+    cookie_str = request.cookies.get(COOKIE_NAME)
+    if cookie_str:
+        user = await cookie2user(cookie_str)
+        if user:
+            logging.info('set user:%s' % user.email)
+            ctx.user = request.__user__ = user
+    if request.path.startswith('/manage/') and (ctx.user is None or not ctx.user.admin):
+        return web.HTTPFound('/signin')
+    return None
+
+
+def set_etag(resp):
+    # 对完整的200响应体计算强ETag，已经带有ETag的响应（如缓存命中）直接复用
+    etag = resp.headers.get('ETag')
+    if etag is None and type(resp) is web.Response and resp.status == 200 and isinstance(resp.body, bytes):
+        etag = '"%s"' % hashlib.sha1(resp.body).hexdigest()
+        resp.headers['ETag'] = etag
+    return etag
+
+
+def etag_matches(request, etag):
+    if_none_match = request.headers.get('If-None-Match')
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == '*':
+        return True
+    for tag in if_none_match.split(','):
+        tag = tag.strip()
+        if tag.startswith('W/'):
+            tag = tag[2:]
+        if tag == etag:
+            return True
+    return False
+
+
+def conditional(request, resp):
+    etag = set_etag(resp)
+    if etag is not None and etag_matches(request, etag):
+        return web.Response(status=304, headers={'ETag': etag})
+    return resp
+
+
+# (ETag, 编码) -> 压缩后的响应体，内容相同的页面不重复压缩
+_compressed_cache = LRUCache(maxsize=16 * 1024 * 1024, weigher=len)
+_COMPRESSIBLE_TYPES = ('text/', 'application/json', 'application/javascript')
+
+
+def choose_encoding(request):
+    accept_encoding = request.headers.get('Accept-Encoding', '').lower()
+    if brotli is not None and 'br' in accept_encoding:
+        return 'br'
+    if 'gzip' in accept_encoding:
+        return 'gzip'
+    return None
+
+
+def compress(request, resp):
+    if type(resp) is not web.Response or resp.status != 200 or not isinstance(resp.body, bytes):
+        return resp
+    if len(resp.body) < configs.compress.min_size or 'Content-Encoding' in resp.headers:
+        return resp
+    if not resp.content_type.startswith(_COMPRESSIBLE_TYPES):
+        return resp
+    resp.headers['Vary'] = 'Accept-Encoding'
+    encoding = choose_encoding(request)
+    if encoding is None:
+        return resp
+    etag = resp.headers.get('ETag')
+    body = _compressed_cache.get((etag, encoding)) if etag else None
+    if body is None:
+        if encoding == 'br':
+            body = brotli.compress(resp.body, quality=configs.compress.brotli_quality)
+        else:
+            body = gzip.compress(resp.body, configs.compress.gzip_level)
+        if etag:
+            _compressed_cache.set((etag, encoding), body)
+    resp.body = body
+    resp.headers['Content-Encoding'] = encoding
+    if etag and not etag.startswith('W/'):
+        # 压缩后的内容与原始内容字节不同，改为弱ETag
+        resp.headers['ETag'] = 'W/' + etag
+    return resp
+
+
+def is_cacheable_page(request, ctx):
+    if request.method != 'GET' or ctx.user is not None:
+        return False
+    return any(pattern.match(request.path) for pattern in app_page_patterns)
+
+
+def page_entry(resp):
+    if type(resp) is not web.Response or resp.status != 200 or resp.cookies or not isinstance(resp.body, bytes):
+        return None
+    headers = {'Content-Type': resp.headers.get('Content-Type', 'text/html;charset=utf-8'), 'ETag': set_etag(resp)}
+    return PageEntry(resp.status, headers, resp.body)
+
+
+async def cached(request, ctx, render):
+    # 匿名页面缓存：同一key未命中时只有第一个请求执行render，其余请求等待其结果
+    key = request.path_qs
+    entry = page_cache.get(key)
+    if entry is None and await page_cache.wait(key):
+        entry = page_cache.get(key)
+    if entry is not None:
+        ctx.timings['cache_hit'] = 0.0
+        return web.Response(status=entry.status, headers=entry.headers, body=entry.body)
+    version = page_cache.begin(key)
+    if version is None:
+        return await render()
+    # 缓存的页面在失效前一直有效，不能用从库中尚未同步的数据生成，生成时只读主库
+    resp = None
+    read_token = orm.read_primary.set(True)
+    try:
+        resp = await render()
+    finally:
+        orm.read_primary.reset(read_token)
+        page_cache.end(key, version, page_entry(resp) if resp is not None else None)
+    return resp
+
+
+# 模版名或路由 -> 上一次输出的字节数，用来预估本次渲染是否需要放到线程池
+_output_sizes = dict()
+
+
+def render_template(template, r):
+    return template.render(**r).encode('utf-8')
+
+
+def should_stream(request, ctx, r):
+    # 可以整页缓存的请求仍然整体渲染，缓存命中时直接返回完整页面
+    if not r.get('__stream__') or not configs.template.stream or request.method != 'GET':
+        return False
+    return not is_cacheable_page(request, ctx)
+
+
+async def stream_template(request, template, r):
+    # 边渲染边发送：<head>和正文先发出，评论等后面的内容渲染完一块发送一块
+    # 不压缩：zlib会攒够数据才输出，分块就失去了意义
+    resp = web.StreamResponse()
+    resp.content_type = 'text/html'
+    resp.charset = 'utf-8'
+    resp.enable_chunked_encoding()
+    await resp.prepare(request)
+    flush_size = configs.template.stream_flush_size
+    buf, size = [], 0
+    for s in template.generate(**r):
+        buf.append(s)
+        size += len(s)
+        if size >= flush_size:
+            await resp.write(''.join(buf).encode('utf-8'))
+            buf, size = [], 0
+    if buf:
+        await resp.write(''.join(buf).encode('utf-8'))
+    await resp.write_eof()
+    return resp
+
+
+async def make_response(app, request, ctx, r):
+    if isinstance(r, web.StreamResponse):
+        return r
+    if isinstance(r, bytes):
+        resp = web.Response(body=r)
+        return resp
+    if isinstance(r, str):
+        if r.startswith('redirect:'):
+            return web.HTTPFound(r[9:])
+        resp = web.Response(body=r.encode('utf-8'))
+        resp.content_type = 'text/html;charset=utf-8'
+        return resp
+    if isinstance(r, dict):
+        template = r.get('__template__')
+        if template is None:
+            key = request.match_info.route
+            with ctx.timer('json'):
+                body = await run_stage('json', _output_sizes.get(key, 0), serializers.dumps, r)
+            _output_sizes[key] = len(body)
+            resp = web.Response(body=body)
+            resp.content_type = 'application/json;charset=utf-8'
             return resp
-        if isinstance(r, str):
-            if r.startswith('redirect:'):
-                return web.HTTPFound(r[9:])
-            resp = web.Response(body=r.encode('utf-8'))
+        else:
+            r['__user__'] = ctx.user
+            if should_stream(request, ctx, r):
+                with ctx.timer('render'):
+                    return await stream_template(request, get_template(app, template), r)
+            with ctx.timer('render'):
+                body = await run_stage('template', _output_sizes.get(template, 0), render_template,
+                                       get_template(app, template), r)
+            _output_sizes[template] = len(body)
+            resp = web.Response(body=body)
             resp.content_type = 'text/html;charset=utf-8'
             return resp
-        if isinstance(r, dict):
-            template = r.get('__template__')
-            if template is None:
-                resp = web.Response(body=json.dumps(r, ensure_ascii=False, default=lambda o: o.__dict__).encode('utf-8'))
-                resp.content_type = 'application/json;charset=utf-8'
-                return resp
+    if isinstance(r, int) and 100 <= r < 600:
+        return web.Response(status=r)
+    if isinstance(r, tuple) and len(r) == 2:
+        v, t = r
+        if isinstance(v, int) and 100 <= v < 600:
+            return web.Response(status=v, text=str(t))
+    resp = web.Response(body=str(r).encode('utf-8'))
+    resp.content_type = 'text/plain;charset=utf-8'
+    return resp
+
+
+async def pipeline_factory(app, handler):
+    # 单一中间件依次执行：认证 -> 匿名页面缓存 -> handler -> 生成响应 -> 条件GET -> 压缩
+    # 请求体只在RequestHandler需要时解析一次，用户、请求体和各阶段耗时都保存在RequestContext中
+    async def pipeline(request):
+        ctx = RequestContext()
+        ctx.query_stats = orm.QueryStats()
+        request['ctx'] = ctx
+        request.__user__ = None
+        # keep-alive连接上的多个请求共用一个task，每个请求重新开始读写分离和sql统计
+        read_token = orm.read_primary.set(False)
+        stats_token = orm.query_stats.set(ctx.query_stats)
+        start = time.perf_counter()
+        status = 500
+        try:
+            if request.path.startswith('/static/'):
+                # 静态文件不需要认证、缓存、生成响应和压缩（已预压缩）
+                resp = await handler(request)
             else:
-                r['__user__'] = request.__user__  # 对于需要用户信息的动态模版，不知道在哪加入用户信息合理，暂时加在这里
-                resp = web.Response(body=app['__templating__'].get_template(template).render(**r).encode('utf-8'))
-                resp.content_type = 'text/html;charset=utf-8'
-                return resp
-        if isinstance(r, int) and 100 <= r < 600:
-            return web.Response(r)
-        if isinstance(r, tuple) and len(r) == 2:
-            v, t = r
-            if isinstance(v, int) and 100 <= v < 600:
-                return web.Response(v, str(r))
-        resp = web.Response(body=str(r).encode('utf-8'))
-        resp.content_type = 'text/plain;charset=utf-8'
-        return resp
-    return response
+                try:
+                    with ctx.timer('auth'):
+                        resp = await authenticate(request, ctx)
+                    if resp is None:
+                        resp = await run_handler(app, request, ctx, handler)
+                except orm.PoolTimeoutError as e:
+                    # 认证和handler中获取数据库连接超时都返回503
+                    logging.warning(str(e))
+                    resp = web.HTTPServiceUnavailable(headers={'Retry-After': '1'})
+                else:
+                    if request.method in ('GET', 'HEAD'):
+                        resp = conditional(request, resp)
+                    with ctx.timer('compress'):
+                        resp = compress(request, resp)
+            status = resp.status
+            return resp
+        except web.HTTPException as e:
+            # 路由的404/405、静态文件的404等以异常形式返回，记录实际状态码
+            status = e.status
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            REQUEST_DURATION.observe(elapsed, request.method, status)
+            logging.info('response:%s %s %s %.1fms, %s, %s' % (request.method, request.path, status,
+                                                                elapsed * 1000, ctx.query_stats, ctx))
+            orm.query_stats.reset(stats_token)
+            orm.read_primary.reset(read_token)
+    return pipeline
+
+
+async def run_handler(app, request, ctx, handler):
+    async def render():
+        with ctx.timer('handler'):
+            r = await handler(request)
+        return await make_response(app, request, ctx, r)
+
+    if is_cacheable_page(request, ctx):
+        return await cached(request, ctx, render)
+    return await render()
 
 
 def time_filter(t):
@@ -121,20 +351,168 @@ def time_filter(t):
 
 async def init(loop):
     await create_pool(loop, **configs.db)
-    app = web.Application(loop=loop, middlewares=[logger_factory, auth_factory, data_factory, response_factory])
-    add_static(app)
+    page_cache.resize(configs.cache.page_size)
+    shared_dir = configs.cache.get('shared_dir')
+    if shared_dir:
+        # 多进程：每个worker各有一份缓存，写操作通过共享目录中的文件通知其他worker失效
+        interval = configs.cache.shared_check_interval
+        page_cache.generation.open(os.path.join(shared_dir, 'pages'), interval)
+        page_cache.set_ttl(configs.cache.shared_page_ttl)
+        session_generation.open(os.path.join(shared_dir, 'sessions'), interval)
+    app_page_patterns[:] = [re.compile(p) for p in configs.cache.pages]
+    app = web.Application(loop=loop, middlewares=[pipeline_factory])
+    add_static(app, precompress=configs.compress.static, min_size=configs.compress.min_size)
     add_routes(app, 'handlers')
-    init_jinja2(app, filters=dict(datetime=time_filter))
+    init_jinja2(app, filters=dict(datetime=time_filter), **configs.template)
+    init_executors(app, **configs.executor)
+    await init_search(app, **configs.search)
     return app
 
 
-def main():
-    loop = asyncio.get_event_loop()
+def create_socket(host, port, reuse_port=False, backlog=128):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    sock.set_inheritable(True)
+    return sock
+
+
+def run_worker(sock, db_options, shared_dir):
+    # 子进程：使用自己的事件循环和连接池，SIGTERM时由run_app完成优雅退出
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    configs.db.update(db_options)
+    configs.cache.shared_dir = shared_dir
+    set_const_labels(pid=os.getpid())
     app = loop.run_until_complete(init(loop))
-    logging.info('server started at http://127.0.0.1:9000 ...')
-    web.run_app(app, host='172.16.3.111', port=9000)
+    web.run_app(app, sock=sock, print=None, shutdown_timeout=configs.server.graceful_timeout)
+
+
+class Master(object):
+    # 预先fork出多个worker进程共享监听端口：
+    # reuse_port为True时每个worker各自绑定带SO_REUSEPORT的socket，由内核分发连接；否则继承主进程的socket
+    # SIGHUP：启动新一批worker后让旧worker处理完现有请求退出；SIGTERM/SIGINT：全部退出
+    def __init__(self, server, db):
+        self.host = server.host
+        self.port = server.port
+        self.workers = server.workers or os.cpu_count() or 1
+        self.reuse_port = server.reuse_port
+        self.graceful_timeout = server.graceful_timeout
+        # 总连接数预算平均分给每个worker
+        budget = db.get('pool_budget') or db.get('maxsize', 10) * self.workers
+        maxsize = max(1, budget // self.workers)
+        self.db_options = dict(maxsize=maxsize, minsize=min(db.get('minsize', 1), maxsize))
+        self.sock = None
+        # worker之间缓存失效通知使用的目录
+        self.shared_dir = None
+        self.children = dict()
+        self.stopping = False
+        self.reload = False
+
+    def spawn(self):
+        sock = create_socket(self.host, self.port, True) if self.reuse_port else self.sock
+        pid = os.fork()
+        if pid == 0:
+            for sig in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT):
+                signal.signal(sig, signal.SIG_DFL)
+            try:
+                run_worker(sock, self.db_options, self.shared_dir)
+            except BaseException as e:
+                logging.exception(e)
+                os._exit(1)
+            os._exit(0)
+        if self.reuse_port:
+            sock.close()
+        self.children[pid] = time.time()
+        logging.info('worker %s started' % pid)
+        return pid
+
+    def kill(self, pids, sig=signal.SIGTERM):
+        for pid in pids:
+            try:
+                os.kill(pid, sig)
+            except ProcessLookupError:
+                pass
+
+    def reap(self):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            started = self.children.pop(pid, None)
+            if started is None:
+                continue
+            logging.info('worker %s exited with status %s' % (pid, status))
+            if not self.stopping:
+                if time.time() - started < 1:
+                    # 启动后立即退出，避免疯狂重启
+                    time.sleep(1)
+                self.spawn()
+
+    def restart(self):
+        logging.info('graceful restart %s workers' % self.workers)
+        old = list(self.children)
+        for _ in range(self.workers):
+            self.spawn()
+        for pid in old:
+            # 旧worker退出后不再补位
+            self.children.pop(pid, None)
+        self.kill(old)
+
+    def run(self):
+        precompress_static(min_size=configs.compress.min_size)
+        self.shared_dir = tempfile.mkdtemp(prefix='blog-website-')
+        if self.reuse_port:
+            # 主进程先绑定一次以尽早发现端口冲突，随即关闭，否则内核会把连接分给不accept的主进程
+            create_socket(self.host, self.port, True).close()
+        else:
+            self.sock = create_socket(self.host, self.port)
+        signal.signal(signal.SIGTERM, self.on_stop)
+        signal.signal(signal.SIGINT, self.on_stop)
+        signal.signal(signal.SIGHUP, self.on_reload)
+        logging.info('master %s started at http://%s:%s with %s workers' % (os.getpid(), self.host, self.port,
+                                                                            self.workers))
+        for _ in range(self.workers):
+            self.spawn()
+        while not self.stopping:
+            if self.reload:
+                self.reload = False
+                self.restart()
+            self.reap()
+            time.sleep(0.5)
+        self.kill(list(self.children))
+        deadline = time.time() + self.graceful_timeout
+        while self.children and time.time() < deadline:
+            self.reap()
+            time.sleep(0.1)
+        self.kill(list(self.children), signal.SIGKILL)
+        if self.sock is not None:
+            self.sock.close()
+        shutil.rmtree(self.shared_dir, ignore_errors=True)
+
+    def on_stop(self, signum, frame):
+        self.stopping = True
+
+    def on_reload(self, signum, frame):
+        self.reload = True
+
+
+def main():
+    server = configs.server
+    if server.workers == 1:
+        loop = asyncio.get_event_loop()
+        app = loop.run_until_complete(init(loop))
+        logging.info('server started at http://%s:%s ...' % (server.host, server.port))
+        web.run_app(app, host=server.host, port=server.port)
+    else:
+        Master(server, configs.db).run()
 
 
 if __name__ == '__main__':
     main()
-
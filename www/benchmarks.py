@@ -0,0 +1,182 @@
+import sys, time, gc, asyncio, logging, tracemalloc
+from urllib import parse
+from models import Blog, next_id
+
+'''
+性能基准测试：python benchmarks.py [名称...]，不带参数时运行全部
+'''
+
+
+def make_rows(n):
+    # 模拟DictCursor返回的blogs行
+    now = time.time()
+    return [dict(id=next_id(), user_id=next_id(), user_name='user%s' % i, user_image='/static/img/default.png',
+                 name='blog %s' % i, summary='summary of blog %s' % i, content='content ' * 20,
+                 html_content='<p>%s</p>' % ('content ' * 20), created_at=now - i) for i in range(n)]
+
+
+def measure_hydration(factory, rows):
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    objs = [factory(**r) for r in rows]
+    elapsed = time.perf_counter() - start
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del objs
+    return elapsed, size
+
+
+def bench_models(n=100000):
+    rows = make_rows(n)
+    print('hydrate %s rows' % n)
+    for label, factory in (('Model (dict)', Blog), ('Record (__slots__)', Blog.__record__)):
+        elapsed, size = measure_hydration(factory, rows)
+        print('  %-20s %8.1f ms %8.1f MB %6d bytes/row' % (label, elapsed * 1000, size / 1024 / 1024, size // n))
+
+
+class LegacyRequestHandler(object):
+    # 预编译参数绑定之前的RequestHandler.__call__（GET部分），作为对比基准
+
+    def __init__(self, func):
+        from coroweb import get_required_kwargs, get_named_kwargs, has_var_kwargs, has_named_kwargs, has_request_arg
+        self._func = func
+        self._required_kwargs = get_required_kwargs(func)
+        self._named_kwargs = get_named_kwargs(func)
+        self._has_var_kwargs = has_var_kwargs(func)
+        self._has_named_kwargs = has_named_kwargs(func)
+        self._has_request_arg = has_request_arg(func)
+
+    async def __call__(self, request):
+        kw = None
+        if self._has_var_kwargs or self._has_named_kwargs or self._required_kwargs:
+            if request.method == 'GET':
+                qs = request.query_string
+                if qs:
+                    kw = dict()
+                    for k, v in parse.parse_qs(qs, True).items():
+                        kw[k] = v[0]
+        if kw is None:
+            kw = dict(**request.match_info)
+        else:
+            if not self._has_var_kwargs and self._named_kwargs:
+                copy = dict()
+                for k in self._named_kwargs:
+                    if k in kw:
+                        copy[k] = kw[k]
+                kw = copy
+            for k, v in request.match_info.items():
+                if k in kw:
+                    logging.warning('duplicate arg name in named args and key args:%s' % k)
+                kw[k] = v
+        if self._has_request_arg:
+            kw['request'] = request
+        for name in self._required_kwargs:
+            if name not in kw:
+                return None
+        logging.info('call with func:%s;args:%s' % (str(self._func), str(kw)))
+        return await self._func(**kw)
+
+
+def bench_dispatch(n=100000):
+    from aiohttp.test_utils import make_mocked_request
+    from coroweb import RequestHandler
+
+    async def api_blogs(*, page='1', cursor=None):
+        return page
+
+    async def get_blog(blog_id):
+        return blog_id
+
+    # 与生产环境一致：INFO级别的日志被处理但输出丢弃
+    root = logging.getLogger()
+    handlers, level = root.handlers, root.level
+    root.handlers, root.level = [logging.NullHandler()], logging.INFO
+    loop = asyncio.new_event_loop()
+    cases = (('GET /api/blogs?page=3', api_blogs, make_mocked_request('GET', '/api/blogs?page=3&x=1')),
+             ('GET /api/blog/{id}', get_blog, make_mocked_request('GET', '/api/blog/1', match_info={'blog_id': '1'})))
+    try:
+        print('dispatch overhead, %s calls' % n)
+        for label, func, request in cases:
+            for name, handler in (('before', LegacyRequestHandler(func)), ('after', RequestHandler(None, func))):
+                async def run():
+                    for _ in range(n):
+                        await handler(request)
+                start = time.perf_counter()
+                loop.run_until_complete(run())
+                elapsed = time.perf_counter() - start
+                print('  %-24s %-6s %6.2f us/request' % (label, name, elapsed / n * 1e6))
+    finally:
+        loop.close()
+        root.handlers, root.level = handlers, level
+
+
+def bench_json(repeat=20):
+    import serializers
+    from apis import Page
+    from models import Comment
+    print('encode api_blogs/api_comments payloads, orjson %s' % ('on' if serializers.orjson else 'off'))
+    # 没有安装orjson时dumps使用的标准库编码器
+    json_dumps = lambda obj: serializers._encoder.encode(obj).encode('utf-8')
+    for n in (8, 100, 1000):
+        rows = make_rows(n)
+        comments = [dict(id=r['id'], blog_id=r['id'], user_id=r['user_id'], user_name=r['user_name'],
+                         user_image=r['user_image'], content=r['summary'], html_content=r['summary'],
+                         created_at=r['created_at']) for r in rows]
+        cases = (('blogs', Blog, rows), ('comments', Comment, comments))
+        for label, model, data in cases:
+            page = Page(n, 1, n)
+            # 两种编码器分别编码Model（dict）和Record（__slots__）两种行对象
+            for row_type, factory in (('Model', model), ('Record', model.__record__)):
+                payload = dict(page=page, items=[factory(**r) for r in data])
+                for name, func in (('json', json_dumps), ('orjson', serializers.dumps)):
+                    start = time.perf_counter()
+                    for _ in range(repeat):
+                        body = func(payload)
+                    elapsed = (time.perf_counter() - start) / repeat
+                    print('  %-9s %5d rows %-6s %-6s %8.2f ms %8d bytes' % (label, n, row_type, name,
+                                                                         elapsed * 1000, len(body)))
+
+
+def bench_templates(n=2000):
+    import tempfile
+    from app import init_jinja2, get_template, render_template, time_filter
+    from apis import Page, CursorPage
+    from models import Comment
+    rows = make_rows(8)
+    blogs = [Blog(**r) for r in rows]
+    comments = [Comment(id=next_id(), blog_id=rows[0]['id'], user_id=r['user_id'], user_name=r['user_name'],
+                        user_image=r['user_image'], content=r['summary'], html_content='<p>%s</p>' % r['summary'],
+                        created_at=r['created_at']) for r in make_rows(20)]
+    cases = (('blogs.html', dict(page=Page(100, 2), blogs=blogs, __user__=None)),
+             ('blog.html', dict(blog=Blog(**rows[0]), comments=comments, comment_page=CursorPage(),
+                                __user__=None)))
+    filters = dict(datetime=time_filter)
+    with tempfile.TemporaryDirectory() as cache_dir:
+        # 启动开销：从源码编译 vs 从字节码缓存加载
+        print('startup, compile all templates')
+        for label in ('compile', 'compile+write bytecode', 'load bytecode'):
+            app = dict()
+            start = time.perf_counter()
+            init_jinja2(app, filters=filters, auto_reload=False, precompile=True,
+                        bytecode_cache=cache_dir if label != 'compile' else None)
+            print('  %-24s %8.1f ms' % (label, (time.perf_counter() - start) * 1000))
+        print('render latency, %s renders' % n)
+        for name, r in cases:
+            for label, options in (('auto_reload', dict(auto_reload=True)),
+                                   ('cached template', dict(auto_reload=False, precompile=True, bytecode_cache=cache_dir))):
+                app = dict()
+                init_jinja2(app, filters=filters, **options)
+                start = time.perf_counter()
+                for _ in range(n):
+                    render_template(get_template(app, name), r)
+                elapsed = time.perf_counter() - start
+                print('  %-12s %-16s %8.1f us/render' % (name, label, elapsed / n * 1e6))
+
+
+BENCHMARKS = dict(models=bench_models, dispatch=bench_dispatch, json=bench_json, templates=bench_templates)
+
+
+if __name__ == '__main__':
+    for name in sys.argv[1:] or list(BENCHMARKS):
+        BENCHMARKS[name]()
@@ -0,0 +1,210 @@
+import time, fcntl, asyncio
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    # 进程内LRU缓存，超过容量时淘汰最久未使用的条目，条目可带过期时间
+    # weigher不为空时容量按weigher(value)累计计算，否则按条目数计算
+    def __init__(self, maxsize=1024, ttl=None, weigher=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._weigher = weigher
+        self._data = OrderedDict()
+        self._weight = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return self.get(key, _MISSING) is not _MISSING
+
+    def _weigh(self, value):
+        return self._weigher(value) if self._weigher else 1
+
+    def get(self, key, default=None):
+        entry = self._data.get(key)
+        if entry is None:
+            self.misses += 1
+            return default
+        value, expires = entry
+        if expires is not None and expires < time.time():
+            self.pop(key)
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key, value, ttl=None, expires=None):
+        if expires is None:
+            ttl = self.ttl if ttl is None else ttl
+            expires = time.time() + ttl if ttl is not None else None
+        weight = self._weigh(value)
+        if weight > self.maxsize:
+            self.pop(key)
+            return
+        self.pop(key)
+        self._data[key] = (value, expires)
+        self._weight += weight
+        while self._weight > self.maxsize:
+            _, (v, _) = self._data.popitem(last=False)
+            self._weight -= self._weigh(v)
+
+    def pop(self, key, default=None):
+        entry = self._data.pop(key, None)
+        if entry is None:
+            return default
+        self._weight -= self._weigh(entry[0])
+        return entry[0]
+
+    def replace(self, key, value):
+        # 只替换已存在条目的值，保留原有过期时间
+        entry = self._data.get(key)
+        if entry is not None:
+            self.set(key, value, expires=entry[1])
+
+    def keys(self):
+        return list(self._data)
+
+    def discard(self, predicate):
+        for key in [k for k in self._data if predicate(k)]:
+            self.pop(key)
+
+    def clear(self):
+        self._data.clear()
+        self._weight = 0
+
+
+_MISSING = object()
+
+
+class PageEntry(object):
+    __slots__ = ('status', 'headers', 'body')
+
+    def __init__(self, status, headers, body):
+        self.status = status
+        self.headers = headers
+        self.body = body
+
+
+class SharedGeneration(object):
+    # 多进程之间的失效通知：共享文件中保存一个计数器，bump()在文件锁内加一，
+    # 其他进程的changed()发现计数器变化后清空各自的缓存；没有调用open（单进程）时什么都不做
+    def __init__(self):
+        self.path = None
+        self.check_interval = 1
+        self._seen = None
+        self._checked_at = 0
+
+    def open(self, path, check_interval=1):
+        self.path = path
+        self.check_interval = check_interval
+        self._seen = self._locked(fcntl.LOCK_SH, self._read)
+
+    def _locked(self, mode, func):
+        # 文件关闭时释放锁
+        with open(self.path, 'a+') as f:
+            fcntl.flock(f, mode)
+            return func(f)
+
+    @staticmethod
+    def _read(f):
+        f.seek(0)
+        data = f.read().strip()
+        return int(data) if data else 0
+
+    @staticmethod
+    def _increment(f):
+        n = SharedGeneration._read(f)
+        f.truncate(0)
+        f.write(str(n + 1))
+        f.flush()
+        return n
+
+    def bump(self):
+        # 返回True表示上次检查之后其他进程也发出过通知，调用方需要清空全部缓存
+        if self.path is None:
+            return False
+        n = self._locked(fcntl.LOCK_EX, self._increment)
+        foreign = n != self._seen
+        self._seen = n + 1
+        return foreign
+
+    def changed(self):
+        # 最多每check_interval秒检查一次文件
+        if self.path is None:
+            return False
+        now = time.time()
+        if now - self._checked_at < self.check_interval:
+            return False
+        self._checked_at = now
+        n = self._locked(fcntl.LOCK_SH, self._read)
+        if n == self._seen:
+            return False
+        self._seen = n
+        return True
+
+
+class PageCache(object):
+    # 匿名GET请求的响应缓存，key为path+query
+    # 同一key未命中时，后来的请求等待第一个请求生成结果，避免并发重复执行handler
+    # 多进程时通过generation通知其他worker清空缓存，ttl兜底通知丢失的情况
+    def __init__(self, maxsize=64 * 1024 * 1024, ttl=None):
+        self._cache = LRUCache(maxsize=maxsize, ttl=ttl, weigher=lambda entry: len(entry.body))
+        self._pending = dict()
+        self._version = 0
+        self.generation = SharedGeneration()
+
+    def resize(self, maxsize):
+        self._cache.maxsize = maxsize
+
+    def set_ttl(self, ttl):
+        self._cache.ttl = ttl
+
+    def get(self, key):
+        if self.generation.changed():
+            self._invalidate(())
+        return self._cache.get(key)
+
+    def begin(self, key):
+        # 返回当前版本号，end时版本号变化说明期间发生过失效，结果不再写入
+        # 已有请求在生成同一key时返回None
+        if key in self._pending:
+            return None
+        self._pending[key] = asyncio.Event()
+        return self._version
+
+    def end(self, key, version, entry=None):
+        if version is None:
+            return
+        if entry is not None and version == self._version:
+            self._cache.set(key, entry)
+        event = self._pending.pop(key, None)
+        if event is not None:
+            event.set()
+
+    async def wait(self, key):
+        event = self._pending.get(key)
+        if event is None:
+            return False
+        await event.wait()
+        return True
+
+    def invalidate(self, *paths):
+        # 不传路径时清空全部缓存；其他worker收到通知后清空全部缓存
+        self._invalidate(paths)
+        if self.generation.bump():
+            self._invalidate(())
+
+    def _invalidate(self, paths):
+        self._version += 1
+        if not paths:
+            self._cache.clear()
+            return
+        paths = set(paths)
+        self._cache.discard(lambda key: key.split('?', 1)[0] in paths)
+
+
+page_cache = PageCache()
@@ -4,9 +4,79 @@ configs = {
         'port': 3306,
         'user': 'blog_admin',
         'password': 'Kingview01!',
-        'db': 'blog_website'
+        'db': 'blog_website',
+        'count_cache_ttl': 60,
+        # 只读副本，例如[{'host': '10.0.0.2'}, {'host': '10.0.0.3', 'port': 3307}]，未配置的项沿用主库配置
+        'replicas': [],
+        'replica_strategy': 'round_robin',
+        'replica_eject_seconds': 30,
+        'health_check_interval': 10,
+        'slow_query_ms': 500,
+        'minsize': 1,
+        'maxsize': 10,
+        # 获取连接的超时时间（秒），超时返回503
+        'acquire_timeout': 5,
+        # 根据等待时间在[minsize, maxsize]之间自动调整并发上限
+        'adaptive_pool': False,
+        # 多进程时所有worker的连接总数，为空时每个worker使用maxsize
+        'pool_budget': None,
+        'pool_grow_wait_ms': 20
+    },
+    'server': {
+        'host': '172.16.3.111',
+        'port': 9000,
+        # worker进程数，0表示按cpu核数，1为单进程
+        'workers': 1,
+        'reuse_port': False,
+        'graceful_timeout': 30
     },
     'session': {
-        'secret': 'secret_string'
+        'secret': 'secret_string',
+        'cache_size': 10000,
+        'cache_ttl': 300
+    },
+    'markdown': {
+        'cache_size': 32 * 1024 * 1024
+    },
+    'cache': {
+        'page_size': 64 * 1024 * 1024,
+        'pages': [r'^/$', r'^/api/blog/[^/]+$'],
+        # 多进程时：页面缓存的最长有效期（秒），以及检查其他worker失效通知的间隔（秒）
+        'shared_page_ttl': 10,
+        'shared_check_interval': 1
+    },
+    'executor': {
+        # 进程池用于Markdown渲染，线程池用于模版渲染和json编码，为0时不启用
+        'process_workers': 2,
+        'thread_workers': 4,
+        # 超过阈值（字符数/预估输出字节数）才放到池中执行
+        'markdown_threshold': 4096,
+        'template_threshold': 32 * 1024,
+        'json_threshold': 64 * 1024
+    },
+    'template': {
+        # 开发时设为True，修改模版后无需重启
+        'auto_reload': False,
+        'precompile': True,
+        # True使用系统临时目录，或指定缓存目录，None为不缓存字节码
+        'bytecode_cache': True,
+        # 对返回__stream__的handler分块发送页面（不压缩），按字符数攒够一块再发送
+        'stream': False,
+        'stream_flush_size': 8 * 1024
+    },
+    'search': {
+        # 索引文件，相对路径相对于www目录
+        'path': 'search_index.json.gz',
+        # 修改后延迟保存的秒数，以及检查其他worker是否更新了索引文件的间隔
+        'save_delay': 5,
+        'check_interval': 2,
+        'k1': 1.2,
+        'b': 0.75
+    },
+    'compress': {
+        'min_size': 1024,
+        'gzip_level': 6,
+        'brotli_quality': 5,
+        'static': True
     }
 }
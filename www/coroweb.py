@@ -1,7 +1,10 @@
-import asyncio, os, inspect, logging, functools
+import asyncio, os, time, inspect, logging, functools, contextlib, gzip, hashlib, mimetypes
 from aiohttp import web
-from urllib import parse
 from apis import APIError
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 
 def get(path):
@@ -72,7 +75,66 @@ def has_request_arg(func):
     return found
 
 
+def get_kwarg_converters(func):
+    # 为标注了int/float/bool类型的关键字参数生成转换函数
+    converters = dict()
+    for name, param in inspect.signature(func).parameters.items():
+        if param.kind != inspect.Parameter.KEYWORD_ONLY:
+            continue
+        if param.annotation in (int, float):
+            converters[name] = param.annotation
+        elif param.annotation is bool:
+            converters[name] = lambda v: v if isinstance(v, bool) else str(v).lower() in ('1', 'true', 'yes', 'on')
+    return converters
+
+
+class RequestContext(object):
+    # 单个请求的上下文：当前用户、解析后的请求体、sql统计和各阶段耗时，保存在request['ctx']中
+    __slots__ = ('user', 'data', 'query_stats', 'timings')
+
+    def __init__(self):
+        self.user = None
+        self.data = None
+        self.query_stats = None
+        self.timings = dict()
+
+    @contextlib.contextmanager
+    def timer(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[stage] = self.timings.get(stage, 0.0) + time.perf_counter() - start
+
+    def __str__(self):
+        return ', '.join('%s:%.1fms' % (k, v * 1000) for k, v in self.timings.items())
+
+
+async def read_body(request):
+    # 解析POST请求体，同一请求只解析一次，结果保存在RequestContext中
+    ctx = request.get('ctx')
+    if ctx is not None and ctx.data is not None:
+        return ctx.data
+    ct = request.content_type.lower()
+    if ct in _JSON_TYPES:
+        data = await request.json()
+    elif ct in _FORM_TYPES:
+        data = await request.post()
+    elif 'Content-Type' not in request.headers:
+        raise web.HTTPBadRequest(text='Missing content_type')
+    else:
+        raise web.HTTPBadRequest(text='unexpected content-type:%s' % ct)
+    if ctx is not None:
+        ctx.data = data
+    return data
+
+
+_JSON_TYPES = frozenset(['application/json'])
+_FORM_TYPES = frozenset(['application/x-www-form-urlencoded', 'multipart/form-data'])
+
+
 class RequestHandler(object):
+    # 在add_route时根据handler的签名生成参数绑定函数，请求时只执行该handler需要的逻辑
 
     def __init__(self, app, func):
         self._app = app
@@ -82,49 +144,76 @@ class RequestHandler(object):
         self._has_var_kwargs = has_var_kwargs(func)
         self._has_named_kwargs = has_named_kwargs(func)
         self._has_request_arg = has_request_arg(func)
-
-    async def __call__(self, request):
-        kw = None
-        if self._has_var_kwargs or self._has_named_kwargs or self._required_kwargs:
+        self._converters = get_kwarg_converters(func)
+        self._bind = self._make_binder()
+
+    def _make_binder(self):
+        # 只保留签名中声明的关键字参数，有**kw时保留全部
+        named = None if self._has_var_kwargs else frozenset(self._named_kwargs)
+        required = self._required_kwargs
+        converters = self._converters
+        has_request_arg = self._has_request_arg
+
+        def select(params):
+            if named is None:
+                return dict(params)
+            return dict((k, params[k]) for k in named if k in params)
+
+        async def read_params(request):
             if request.method == 'POST':
-                if not request.content_type:
-                    return web.HTTPBadRequest('Missing content_type')
-                ct = request.content_type.lower()
-                if ct.startswith('application/json'):
-                    params = await request.json()
-                    if not isinstance(params, dict):
-                        return web.HTTPBadRequest('json body must be object')
-                    kw = params
-                elif ct.startswith('application/x-www-form-urlencoded') or ct.startswith('multipate/form-data'):
-                    params = await request.post()
-                    kw = dict(**params)
-                else:
-                    return web.HTTPBadRequest('unexpected content-type:%s' % ct)
-            if request.method == 'GET':
-                qs = request.query_string
-                if qs:
-                    kw = dict()
-                    for k, v in parse.parse_qs(qs, True).items():
-                        kw[k] = v[0]
-        if kw is None:
-            kw = dict(**request.match_info)
-        else:
-            if not self._has_var_kwargs and self._named_kwargs:
-                copy = dict()
-                for k in self._named_kwargs:
+                params = await read_body(request)
+                if not hasattr(params, 'keys'):
+                    raise web.HTTPBadRequest(text='json body must be object')
+                return select(params)
+            if request.method == 'GET' and request.query_string:
+                # request.query由aiohttp解析并缓存，同名参数取第一个值
+                query = request.query
+                if named is None:
+                    return dict((k, query[k]) for k in query.keys())
+                return dict((k, query[k]) for k in named if k in query)
+            return None
+
+        if not (self._has_var_kwargs or self._has_named_kwargs or required):
+            # 只用到路径参数
+            async def bind_match_info(request):
+                kw = dict(request.match_info)
+                if has_request_arg:
+                    kw['request'] = request
+                return kw
+            return bind_match_info
+
+        async def bind(request):
+            kw = await read_params(request)
+            if kw is None:
+                kw = dict(request.match_info)
+            else:
+                for k, v in request.match_info.items():
                     if k in kw:
-                        copy[k] = kw[k]
-                kw = copy
-            for k, v in request.match_info.items():
-                if k in kw:
-                    logging.warning('duplicate arg name in named args and key args:%s' % k)
-                kw[k] = v
-        if self._has_request_arg:
-            kw['request'] = request
-        for name in self._required_kwargs:
-            if name not in kw:
-                return web.HTTPBadRequest('Missing argument:{}'.format(name))
-        logging.info('call with func:%s;args:%s' % (str(self._func), str(kw)))
+                        logging.warning('duplicate arg name in named args and key args:%s' % k)
+                    kw[k] = v
+            if has_request_arg:
+                kw['request'] = request
+            for name in required:
+                if name not in kw:
+                    raise web.HTTPBadRequest(text='Missing argument:{}'.format(name))
+            if converters:
+                for name, convert in converters.items():
+                    if name in kw:
+                        try:
+                            kw[name] = convert(kw[name])
+                        except (TypeError, ValueError):
+                            raise web.HTTPBadRequest(text='invalid argument:{}'.format(name))
+            return kw
+
+        return bind
+
+    async def __call__(self, request):
+        try:
+            kw = await self._bind(request)
+        except web.HTTPBadRequest as e:
+            return e
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            logging.debug('call with func:%s;args:%s' % (str(self._func), str(kw)))
         try:
             r = await self._func(**kw)
             return r
@@ -132,10 +221,76 @@ class RequestHandler(object):
             return dict(error=e.error, data=e.data, message=e.message)
 
 
-def add_static(app):
-    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
-    app.router.add_static('/static/', path)
-    logging.info('add static %s => %s' % ('/static/', path))
+STATIC_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+# 需要预压缩的静态文件类型，图片和woff字体本身已经是压缩格式
+COMPRESSIBLE_EXTS = ('.js', '.css', '.svg', '.html', '.txt', '.json', '.otf', '.ttf', '.eot')
+# 相对路径 -> 文件内容md5前8位，用于生成带指纹的url
+_static_versions = dict()
+
+
+def _compress_file(src, dst, compress):
+    if os.path.isfile(dst) and os.path.getmtime(dst) >= os.path.getmtime(src):
+        return
+    with open(src, 'rb') as f:
+        data = f.read()
+    # 先写临时文件再改名，避免其他进程读到写了一半的文件
+    tmp = '%s.%s.tmp' % (dst, os.getpid())
+    with open(tmp, 'wb') as f:
+        f.write(compress(data))
+    os.replace(tmp, dst)
+
+
+def precompress_static(path=STATIC_PATH, min_size=1024):
+    # 启动时（或单独执行python coroweb.py）为静态文件生成.gz/.br，已是最新的文件跳过
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            if name.endswith('.gz') or name.endswith('.br'):
+                continue
+            src = os.path.join(root, name)
+            rel = os.path.relpath(src, path).replace(os.sep, '/')
+            with open(src, 'rb') as f:
+                _static_versions[rel] = hashlib.md5(f.read()).hexdigest()[:8]
+            if not name.endswith(COMPRESSIBLE_EXTS) or os.path.getsize(src) < min_size:
+                continue
+            _compress_file(src, src + '.gz', lambda data: gzip.compress(data, 9))
+            if brotli is not None:
+                _compress_file(src, src + '.br', lambda data: brotli.compress(data))
+
+
+def static_url(filename):
+    version = _static_versions.get(filename)
+    if version is None:
+        return '/static/%s' % filename
+    return '/static/%s?v=%s' % (filename, version)
+
+
+async def static_handler(request):
+    filename = request.match_info['filename']
+    path = os.path.normpath(os.path.join(STATIC_PATH, filename))
+    if not path.startswith(STATIC_PATH + os.sep) or not os.path.isfile(path):
+        raise web.HTTPNotFound()
+    content_type, _ = mimetypes.guess_type(path)
+    headers = {'Content-Type': content_type or 'application/octet-stream', 'Vary': 'Accept-Encoding'}
+    version = _static_versions.get(filename)
+    if version is not None and request.query.get('v') == version:
+        headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    else:
+        headers['Cache-Control'] = 'public, max-age=3600'
+    accept_encoding = request.headers.get('Accept-Encoding', '').lower()
+    for encoding, ext in (('br', '.br'), ('gzip', '.gz')):
+        if encoding in accept_encoding and os.path.isfile(path + ext):
+            path = path + ext
+            headers['Content-Encoding'] = encoding
+            break
+    return web.FileResponse(path, headers=headers)
+
+
+def add_static(app, precompress=True, min_size=1024):
+    # 多进程模式下主进程已在fork前完成预压缩，子进程直接继承指纹表
+    if precompress and not _static_versions:
+        precompress_static(STATIC_PATH, min_size)
+    app.router.add_route('GET', '/static/{filename:.*}', static_handler)
+    logging.info('add static %s => %s' % ('/static/', STATIC_PATH))
 
 
 def add_route(app, func):
@@ -167,9 +322,5 @@ def add_routes(app, model_name):
             add_route(app, func)
 
 
-
-
-
-
-
-
+if __name__ == '__main__':
+    precompress_static()
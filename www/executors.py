@@ -0,0 +1,58 @@
+import asyncio, time, logging
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from metrics import Histogram
+
+'''
+把Markdown渲染、模版渲染、大对象json编码等CPU密集的工作移出事件循环：
+Markdown用进程池（不受GIL限制），模版和json用线程池；低于阈值的小任务仍在事件循环中直接执行
+'''
+
+STAGE_DURATION = Histogram('blog_stage_duration_seconds', 'CPU heavy stage time by where it ran',
+                           ['stage', 'executor'])
+# 在事件循环中直接执行的时间，即事件循环被阻塞的时间
+LOOP_STALL = Histogram('blog_loop_stall_seconds', 'Time the event loop was blocked by a stage', ['stage'])
+
+_options = dict(markdown_threshold=4096, template_threshold=32 * 1024, json_threshold=64 * 1024)
+_process_pool = None
+_thread_pool = None
+
+
+def init_executors(app, process_workers=2, thread_workers=4, **thresholds):
+    # 需要在worker进程内（fork之后）调用
+    global _process_pool, _thread_pool
+    _options.update(thresholds)
+    if process_workers:
+        _process_pool = ProcessPoolExecutor(process_workers)
+    if thread_workers:
+        _thread_pool = ThreadPoolExecutor(thread_workers)
+
+    async def shutdown(app):
+        global _process_pool, _thread_pool
+        for pool in (_process_pool, _thread_pool):
+            if pool is not None:
+                pool.shutdown(wait=False)
+        _process_pool = _thread_pool = None
+
+    app.on_cleanup.append(shutdown)
+
+
+def threshold(stage):
+    return _options['%s_threshold' % stage]
+
+
+async def run_stage(stage, size, func, *args, process=False):
+    # size不小于该阶段的阈值时放到进程池/线程池执行
+    pool = _process_pool if process else _thread_pool
+    start = time.perf_counter()
+    if pool is None or size < threshold(stage):
+        result = func(*args)
+        elapsed = time.perf_counter() - start
+        STAGE_DURATION.observe(elapsed, stage, 'loop')
+        LOOP_STALL.observe(elapsed, stage)
+    else:
+        result = await asyncio.get_event_loop().run_in_executor(pool, func, *args)
+        elapsed = time.perf_counter() - start
+        STAGE_DURATION.observe(elapsed, stage, 'process' if process else 'thread')
+    if logging.getLogger().isEnabledFor(logging.DEBUG):
+        logging.debug('stage %s size:%s %.1fms' % (stage, size, elapsed * 1000))
+    return result
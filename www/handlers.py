@@ -1,16 +1,25 @@
-import re, time, json, hashlib, base64, logging, markdown
+import re, time, asyncio, hashlib, base64, logging, markdown
 from aiohttp import web
 from coroweb import get, post
 from models import User, Comment, Blog, next_id
-from apis import Page, APIPermissionError, APIResourceNotFoundError, APIValueError, APIError
+import orm
+from orm import create_args_placeholder_str
+from apis import Page, CursorPage, APIPermissionError, APIResourceNotFoundError, APIValueError, APIError
 from config import configs
+from cache import LRUCache, SharedGeneration, page_cache
+from metrics import generate_latest
+from executors import run_stage
+import serializers
+import search
 '''
-获取日志列表：GET /api/blogs
+获取日志列表：GET /api/blogs （?page=页码 或 ?cursor=游标，cursor为空串时取第一页）
+搜索日志：GET /api/search?q=关键词&page=页码
 创建日志：POST /api/blogs
 修改日志：POST /api/blogs/:blog_id
 删除日志：POST /api/blogs/:blog_id/delete
 获取评论：GET /api/comments
 创建评论：POST /api/blogs/:blog_id/comments
+获取日志的评论：GET /api/blogs/:blog_id/comments （?page=页码 或 ?cursor=游标）
 删除评论：POST /api/comments/:comment_id/delete
 创建新用户：POST /api/users
 获取用户：GET /api/users
@@ -19,15 +28,22 @@ from config import configs
 创建日志页：GET /manage/blogs/create
 修改日志页：GET /manage/blogs/edit
 用户列表页：GET /manage/users
+运行指标：GET /manage/metrics （多进程时每个worker的指标各自独立，带pid标签，每次只返回应答的worker）
 注册页：GET /register
 登录页：GET /signin
 注销页：GET /signout
 首页：GET /
+导出日志：GET /api/export/blogs
+导出评论：GET /api/export/comments
 日志详情页：GET /blog/:blog_id
 '''
 
 COOKIE_NAME = 'blog-website'
 _COOKIE_KEY = configs.session.secret
+# cookie字符串 -> User，缓存的有效期不会超过cookie本身的过期时间
+_session_cache = LRUCache(maxsize=configs.session.get('cache_size', 10000), ttl=configs.session.get('cache_ttl', 300))
+# 多进程时通知其他worker清空会话缓存，由app在启动时打开
+session_generation = SharedGeneration()
 
 
 def check_admin(user):
@@ -46,6 +62,12 @@ def get_page_index(page_str):
     return p
 
 
+async def find_cursor_page(cls, cursor, where=None, args=None, compact=False):
+    p = CursorPage(cursor)
+    items = await cls.findAll(where, args, limit=p.limit, compact=compact, **p.seek)
+    return p, p.paginate(items)
+
+
 def user2cookie(user, max_age):
     expires = str(int(time.time() + max_age))
     s = '%s-%s-%s-%s' % (user.id, user.passwd, expires, _COOKIE_KEY)
@@ -54,9 +76,21 @@ def user2cookie(user, max_age):
     return '-'.join(L)
 
 
+def invalidate_sessions(uid):
+    # 用户被删除或修改密码后调用，清除该用户所有已缓存的会话
+    _session_cache.discard(lambda cookie_str: cookie_str.split('-', 1)[0] == uid)
+    if session_generation.bump():
+        _session_cache.clear()
+
+
 async def cookie2user(cookie_str):
     if not cookie_str:
         return None
+    if session_generation.changed():
+        _session_cache.clear()
+    cached = _session_cache.get(cookie_str)
+    if cached is not None:
+        return User(**cached)
     try:
         L = cookie_str.split('-')
         if len(L) != 3:
@@ -72,12 +106,50 @@ async def cookie2user(cookie_str):
             logging.info('invalid cookie_str')
             return None
         user.passwd = '******'
+        _session_cache.set(cookie_str, User(**user), expires=min(int(expires), time.time() + _session_cache.ttl))
         return user
+    except orm.PoolTimeoutError:
+        # 连接池耗尽时不能当作未登录处理，由app返回503
+        raise
     except Exception as e:
         logging.exception(e)
         return None
 
 
+# Markdown渲染结果按源文本的sha1缓存，容量按html字符数计算
+_markdown_cache = LRUCache(maxsize=configs.markdown.get('cache_size', 32 * 1024 * 1024), weigher=len)
+
+
+async def markdown2html(text):
+    key = hashlib.sha1(text.encode('utf-8')).digest()
+    html = _markdown_cache.get(key)
+    if html is None:
+        # 较长的文本放到进程池渲染，不阻塞事件循环
+        html = await run_stage('markdown', len(text), markdown.markdown, text, process=True)
+        _markdown_cache.set(key, html)
+    return html
+
+
+async def stream_json_list(request, items, flush_size=64 * 1024):
+    # 逐条编码并分块写出json数组，不在内存中拼出完整结果
+    resp = web.StreamResponse()
+    resp.content_type = 'application/json'
+    resp.charset = 'utf-8'
+    resp.enable_chunked_encoding()
+    await resp.prepare(request)
+    buf = []
+    size = 0
+    async for chunk in serializers.aiter_dumps(items):
+        buf.append(chunk)
+        size += len(chunk)
+        if size >= flush_size:
+            await resp.write(b''.join(buf))
+            buf, size = [], 0
+    await resp.write(b''.join(buf))
+    await resp.write_eof()
+    return resp
+
+
 def text2html(text):
     lines = filter(lambda s: s.strip() != '', text.split('\n'))
     html_lines = map(lambda s: '<p>%s</p>' % s.replace('&', '&alt;').replace('<', '&lt;').replace('>', '&gt'), lines)
@@ -92,7 +164,7 @@ async def index(*, page='1'):
     if num == 0:
         blogs = []
     else:
-        blogs = await Blog.findAll(orderBy='created_at desc', limit=(p.offset, p.limit))
+        blogs = await Blog.findAll(orderBy='created_at desc', limit=(p.offset, p.limit), prefetch=['user'], compact=True)
     return {
         '__template__': 'blogs.html',
         'page': p,
@@ -143,7 +215,7 @@ async def authenticate(*, email, passwd):
     r.set_cookie(COOKIE_NAME, user2cookie(user, 86400), expires='86400', httponly='True')
     user.passwd = '******'
     r.content_type = 'application/json'
-    r.body = json.dumps(user, ensure_ascii=False).encode('utf-8')
+    r.body = serializers.dumps(user)
     return r
 
 
@@ -183,6 +255,12 @@ async def manage_blogs(*, page='1'):
     }
 
 
+@get('/manage/metrics')
+def manage_metrics():
+    return web.Response(body=generate_latest().encode('utf-8'),
+                        headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+
+
 @get('/manage/blogs/create')
 def manage_create_blog():
     return {
@@ -210,7 +288,12 @@ async def manage_blog_edit(*, blog_id):
 
 
 @get('/api/users')
-async def api_users(*, page='1'):
+async def api_users(*, page='1', cursor=None):
+    if cursor is not None:
+        p, users = await find_cursor_page(User, cursor)
+        for u in users:
+            u.passwd = '******'
+        return dict(page=p, users=users)
     num = await User.findNumber('count(id)')
     p = Page(num, get_page_index(page))
     if num == 0:
@@ -246,12 +329,15 @@ async def api_register_user(*, email, name, passwd):
     r.content_type = 'application/json'
     r.set_cookie(COOKIE_NAME, user2cookie(user, 86400), max_age=86400, httponly='True')
     user.passwd = '******'
-    r.body = json.dumps(user, ensure_ascii=False).encode('utf-8')
+    r.body = serializers.dumps(user)
     return r
 
 
 @get('/api/comments')
-async def api_comments(*, page='1'):
+async def api_comments(*, page='1', cursor=None):
+    if cursor is not None:
+        p, comments = await find_cursor_page(Comment, cursor)
+        return dict(page=p, comments=comments)
     num = await Comment.findNumber('count(id)')
     page_index = get_page_index(page)
     p = Page(num, page_index)
@@ -267,7 +353,14 @@ async def api_delete_comment(comment_id, request):
     comment = await Comment.find(comment_id)
     if comment is None:
         return APIResourceNotFoundError('comment')
-    await comment.remove()
+    async with orm.transaction():
+        await comment.remove()
+        # 最后评论时间从剩余评论中重新取，走comments的(blog_id, created_at)索引
+        await Blog.updateWhere('`comment_count`=greatest(`comment_count`-1, 0), '
+                               '`last_comment_at`=(select max(`created_at`) from `comments` where `blog_id`=?)',
+                               '`id`=?', [comment.blog_id, comment.blog_id])
+    search.search_index.remove_comment(comment)
+    page_cache.invalidate('/', '/api/blog/%s' % comment.blog_id)
     return dict(id=comment_id)
 
 
@@ -282,21 +375,53 @@ async def api_create_comment(blog_id, request, *, content):
     if blog is None:
         raise APIValueError('blog_id')
     comment = Comment(user_name=user.name, user_id=user.id, user_image=user.image, blog_id=blog_id, content=content.strip())
-    await comment.save()
+    comment.html_content = await markdown2html(comment.content)
+    async with orm.transaction():
+        await comment.save()
+        await Blog.updateWhere('`comment_count`=`comment_count`+1, `last_comment_at`=?', '`id`=?',
+                               [comment.created_at, blog_id])
+    search.search_index.add_comment(comment)
+    page_cache.invalidate('/', '/api/blog/%s' % blog_id)
     return comment
 
 
+async def render_comments(comments):
+    # 老数据没有html_content时才在读取时渲染
+    pending = [c for c in comments if not c.html_content]
+    for c, html in zip(pending, await asyncio.gather(*[markdown2html(c.content) for c in pending])):
+        c.html_content = html
+    return comments
+
+
+@get('/api/blogs/{blog_id}/comments')
+async def api_blog_comments(blog_id, *, page='1', cursor=None):
+    blog = await Blog.find(blog_id)
+    if blog is None:
+        raise APIResourceNotFoundError('blog')
+    if cursor is not None:
+        p, comments = await find_cursor_page(Comment, cursor, '`blog_id`=?', [blog_id])
+        return dict(page=p, comments=await render_comments(comments))
+    # 总数直接取日志上的comment_count，不再count
+    p = Page(blog.comment_count, get_page_index(page))
+    if p.limit == 0:
+        return dict(page=p, comments=())
+    comments = await Comment.findAll('`blog_id`=?', [blog_id], orderBy='created_at desc',
+                                     limit=(p.offset, p.limit))
+    return dict(page=p, comments=await render_comments(comments))
+
+
 @get('/api/blog/{blog_id}')
 async def get_blog(blog_id):
     blog = await Blog.find(blog_id)
-    comments = await Comment.findAll('blog_id=?', [blog_id], orderBy='created_at desc')
-    for c in comments:
-        c.html_content = markdown.markdown(c.content)
     if blog:
-        blog.html_content = markdown.markdown(blog.content)
+        # 只取第一页评论，其余通过/api/blogs/:blog_id/comments?cursor=按需加载
+        p, comments = await find_cursor_page(Comment, '', '`blog_id`=?', [blog_id], compact=True)
+        blog.html_content = blog.html_content or await markdown2html(blog.content)
         return {
             '__template__': 'blog.html',
-            'comments': comments,
+            '__stream__': True,
+            'comments': await render_comments(comments),
+            'comment_page': p,
             'blog': blog
         }
     else:
@@ -306,7 +431,10 @@ async def get_blog(blog_id):
 
 
 @get('/api/blogs')
-async def api_blogs(*, page='1'):
+async def api_blogs(*, page='1', cursor=None):
+    if cursor is not None:
+        p, blogs = await find_cursor_page(Blog, cursor)
+        return dict(page=p, blogs=blogs)
     page_index = get_page_index(page)
     num = await Blog.findNumber('count(id)')
     p = Page(num, page_index)
@@ -316,6 +444,25 @@ async def api_blogs(*, page='1'):
     return dict(page=p, blogs=blogs)
 
 
+@get('/api/search')
+async def api_search(*, q='', page='1'):
+    if not q or not q.strip():
+        raise APIValueError('q', 'query can not be empty')
+    index = search.search_index
+    await index.refresh()
+    scores = index.match(q)
+    p = Page(len(scores), get_page_index(page))
+    if not scores:
+        return dict(page=p, blogs=())
+    ids = index.rank(scores, p.offset, p.limit)
+    if not ids:
+        return dict(page=p, blogs=())
+    found = await Blog.findAll('`id` in (%s)' % create_args_placeholder_str(len(ids)), ids)
+    # 按得分排序，数据库中已不存在的日志跳过
+    found = dict((blog.id, blog) for blog in found)
+    return dict(page=p, blogs=[found[i] for i in ids if i in found])
+
+
 @post('/api/blogs/{blog_id}/delete')
 async def api_delete_blogs(blog_id, request):
     user = request.__user__
@@ -324,6 +471,8 @@ async def api_delete_blogs(blog_id, request):
     if blog is None:
         raise APIResourceNotFoundError('blog')
     await blog.remove()
+    search.search_index.remove_blog(blog.id)
+    page_cache.invalidate()
     return dict(id=blog_id)
 
 
@@ -343,7 +492,12 @@ async def api_update_blog(blog_id, request, *, name, summary, content):
     blog.name = name.strip()
     blog.summary = summary.strip()
     blog.content = content.strip()
-    await blog.update()
+    blog.html_content = await markdown2html(blog.content)
+    # 只写修改过的列，comment_count/last_comment_at由评论的创建/删除维护，不能用读到的旧值覆盖
+    await Blog.updateWhere('`name`=?, `summary`=?, `content`=?, `html_content`=?', '`id`=?',
+                           [blog.name, blog.summary, blog.content, blog.html_content, blog_id])
+    search.search_index.add_blog(blog)
+    page_cache.invalidate()
     return blog
 
 
@@ -359,7 +513,10 @@ async def api_create_blog(request, *, name, summary, content):
         raise APIValueError('content', 'content can not be empty')
     blog = Blog(user_name=user.name, user_id=user.id, user_image=user.image, name=name.strip(), summary=summary.strip(),
                 content=content.strip())
+    blog.html_content = await markdown2html(blog.content)
     await blog.save()
+    search.search_index.add_blog(blog)
+    page_cache.invalidate()
     return blog
 
 
@@ -371,15 +528,21 @@ async def api_delete_user(user_id, request):
     user = await User.find(user_id)
     if user is None:
         raise APIResourceNotFoundError('user', 'user is not exist')
-    await user.remove()
-    comments = await Comment.findAll('user_id=?', [buff_id])
-    for c in comments:
-        c.user_name = c.user_name + '(该用户已被删除)'
-        await c.update()
+    async with orm.transaction():
+        await user.remove()
+        await Comment.updateWhere('`user_name`=concat(`user_name`, ?)', '`user_id`=?', ['(该用户已被删除)', buff_id])
+    invalidate_sessions(buff_id)
+    page_cache.invalidate()
     return dict(id=buff_id)
 
 
+@get('/api/export/blogs')
+async def api_export_blogs(request):
+    check_admin(request.__user__)
+    return await stream_json_list(request, Blog.iterate(orderBy='created_at desc', batch_size=500))
 
 
-
-
+@get('/api/export/comments')
+async def api_export_comments(request):
+    check_admin(request.__user__)
+    return await stream_json_list(request, Comment.iterate(orderBy='created_at desc', batch_size=500))
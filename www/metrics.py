@@ -0,0 +1,119 @@
+import math
+
+'''
+进程内指标，按Prometheus文本格式(version 0.0.4)输出
+'''
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_registry = []
+# 附加到所有指标上的标签，多进程时每个worker带上pid：指标是每个worker各自的，每次抓取只返回应答的那个worker
+_const_labels = []
+
+
+def set_const_labels(**labels):
+    _const_labels[:] = sorted(labels.items())
+
+
+def _format_labels(labelnames, labels, extra=()):
+    pairs = _const_labels + list(zip(labelnames, labels)) + list(extra)
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in pairs)
+
+
+def _format_value(v):
+    if v == math.inf:
+        return '+Inf'
+    return repr(float(v))
+
+
+class Metric(object):
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        _registry.append(self)
+
+    def samples(self):
+        return []
+
+    def expose(self):
+        lines = ['# HELP %s %s' % (self.name, self.documentation), '# TYPE %s %s' % (self.name, self.type)]
+        for name, labels, value in self.samples():
+            lines.append('%s%s %s' % (name, labels, _format_value(value)))
+        return lines
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def __init__(self, name, documentation, labelnames=()):
+        super(Counter, self).__init__(name, documentation, labelnames)
+        self._values = dict()
+
+    def inc(self, amount=1, *labels):
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def samples(self):
+        return [(self.name, _format_labels(self.labelnames, k), v) for k, v in sorted(self._values.items())]
+
+
+class Gauge(Metric):
+    # 取值由回调函数在输出时计算，回调返回{labels元组: 值}
+    type = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=(), callback=None):
+        super(Gauge, self).__init__(name, documentation, labelnames)
+        self._values = dict()
+        self._callback = callback
+
+    def set(self, value, *labels):
+        self._values[labels] = value
+
+    def samples(self):
+        values = self._callback() if self._callback else self._values
+        return [(self.name, _format_labels(self.labelnames, k), v) for k, v in sorted(values.items())]
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        self._values = dict()
+
+    def observe(self, value, *labels):
+        entry = self._values.get(labels)
+        if entry is None:
+            entry = self._values[labels] = [[0] * len(self.buckets), 0.0, 0]
+        counts = entry[0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[i] += 1
+                break
+        entry[1] += value
+        entry[2] += 1
+
+    def samples(self):
+        samples = []
+        for labels, (counts, total, count) in sorted(self._values.items()):
+            cumulative = 0
+            for bound, c in zip(self.buckets, counts):
+                cumulative += c
+                le = '+Inf' if bound == math.inf else repr(bound)
+                samples.append(('%s_bucket' % self.name, _format_labels(self.labelnames, labels, [('le', le)]),
+                                cumulative))
+            samples.append(('%s_sum' % self.name, _format_labels(self.labelnames, labels), total))
+            samples.append(('%s_count' % self.name, _format_labels(self.labelnames, labels), count))
+        return samples
+
+
+def generate_latest():
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.expose())
+    return '\n'.join(lines) + '\n'
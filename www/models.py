@@ -1,5 +1,5 @@
 import time, uuid
-from orm import Model, IntField, FloatField, BooleanField, TextField, StringField
+from orm import Model, IntField, FloatField, BooleanField, TextField, StringField, BelongsTo, HasMany
 
 
 def next_id():
@@ -17,6 +17,9 @@ class User(Model):
     image = StringField(ddl='varchar(500)')
     created_at = FloatField(default=time.time)
 
+    blogs = HasMany('Blog', 'user_id', orderBy='created_at desc')
+    comments = HasMany('Comment', 'user_id', orderBy='created_at desc')
+
 
 class Blog(Model):
     __table__ = 'blogs'
@@ -28,8 +31,16 @@ class Blog(Model):
     name = StringField(ddl='varchar(50)')
     summary = StringField(ddl='varchar(200)')
     content = TextField()
+    # 列表页和列表接口用不到渲染后的html，只在博客详情中读取
+    html_content = TextField(detail=True)
+    # 评论数和最后评论时间随评论的创建/删除增量更新
+    comment_count = IntField()
+    last_comment_at = FloatField(default=None)
     created_at = FloatField(default=time.time)
 
+    user = BelongsTo('User', 'user_id', exclude=('passwd',))
+    comments = HasMany('Comment', 'blog_id', orderBy='created_at desc')
+
 
 class Comment(Model):
     __table__ = 'comments'
@@ -40,6 +51,8 @@ class Comment(Model):
     user_image = StringField(ddl='varchar(500)')
     blog_id = StringField(ddl='varchar(50)')
     content = TextField()
+    html_content = TextField()
     created_at = FloatField(default=time.time)
 
-
+    user = BelongsTo('User', 'user_id', exclude=('passwd',))
+    blog = BelongsTo('Blog', 'blog_id')
@@ -1,14 +1,283 @@
-import aiomysql, asyncio, logging
+import aiomysql, asyncio, logging, functools, contextvars, itertools, time, collections
+from cache import LRUCache
+from metrics import Counter, Gauge, Histogram
 
 
 def log(sql, args=()):
     logging.info('SQL:%s,args:%s' % (sql, args))
 
 
-async def create_pool(loop, **kwargs):
-    log('create database connection pool...')
-    global __pool
-    __pool = await aiomysql.create_pool(
+# 已拼好的查询语句，key见Model.compileSelect
+_compiled_sql = LRUCache(maxsize=1024)
+
+
+@functools.lru_cache(maxsize=1024)
+def driver_sql(sql):
+    # 把?占位符转换成驱动使用的%s，同一条语句只转换一次
+    return sql.replace('?', '%s')
+
+
+# 行数缓存：key为(表名, 统计字段, where, args)，本进程内的save/remove会增量调整，
+# 其他进程写入的数据依靠ttl过期兜底
+_count_cache = LRUCache(maxsize=1024, ttl=60)
+
+
+def _is_row_count(table, selectfield, where):
+    return where is None and selectfield.replace(' ', '').lower() in ('count(*)', 'count(id)', 'count(`id`)')
+
+
+def adjust_counts(table, delta):
+    # 事务中的调整推迟到提交之后，回滚时丢弃
+    tx = _transaction.get()
+    if tx is not None:
+        tx.counts.append((table, delta))
+        return
+    for key in _count_cache.keys():
+        if key[0] != table:
+            continue
+        if _is_row_count(*key[:3]):
+            # update（delta为0）不改变总行数，保留缓存
+            if delta:
+                value = _count_cache.get(key)
+                if value is not None:
+                    _count_cache.replace(key, max(value + delta, 0))
+        else:
+            _count_cache.pop(key)
+
+
+def invalidate_counts(table=None):
+    if table is None:
+        _count_cache.clear()
+    else:
+        _count_cache.discard(lambda key: key[0] == table)
+
+
+# 当前请求执行过写操作后置为True，之后的读也走主库，保证读到自己刚写入的数据
+# 由app中的中间件在每个请求开始时重置
+read_primary = contextvars.ContextVar('read_primary', default=False)
+# 当前所在的事务，见transaction()
+_transaction = contextvars.ContextVar('transaction', default=None)
+# 只读副本出错时可能是连接问题，剔除该副本并改读主库
+_CONNECTION_ERRORS = (OSError, asyncio.TimeoutError, aiomysql.OperationalError, aiomysql.InterfaceError)
+
+
+SQL_DURATION = Histogram('blog_sql_duration_seconds', 'SQL execution time, excluding pool wait', ['kind'])
+SQL_POOL_WAIT = Histogram('blog_sql_pool_wait_seconds', 'Time spent waiting for a pooled connection', ['kind'])
+SQL_ROWS = Counter('blog_sql_rows_total', 'Rows returned by select or affected by execute', ['kind'])
+SQL_SLOW = Counter('blog_sql_slow_queries_total', 'Queries slower than the slow query threshold', ['kind'])
+# 慢查询阈值，单位秒，由db.slow_query_ms配置
+_slow_query_seconds = [0.5]
+
+
+class QueryStats(object):
+    # 单个请求内的sql统计，由app中的中间件创建并在请求结束时输出
+    __slots__ = ('count', 'elapsed', 'wait', 'rows')
+
+    def __init__(self):
+        self.count = 0
+        self.elapsed = 0.0
+        self.wait = 0.0
+        self.rows = 0
+
+    def __str__(self):
+        return 'queries:%s, sql:%.1fms, pool wait:%.1fms, rows:%s' % (self.count, self.elapsed * 1000,
+                                                                      self.wait * 1000, self.rows)
+
+
+query_stats = contextvars.ContextVar('query_stats', default=None)
+
+
+def record_query(kind, sql, args, elapsed, wait, rows):
+    SQL_DURATION.observe(elapsed, kind)
+    SQL_POOL_WAIT.observe(wait, kind)
+    SQL_ROWS.inc(rows, kind)
+    stats = query_stats.get()
+    if stats is not None:
+        stats.count += 1
+        stats.elapsed += elapsed
+        stats.wait += wait
+        stats.rows += rows
+    if elapsed >= _slow_query_seconds[0]:
+        SQL_SLOW.inc(1, kind)
+        logging.warning('slow query %.1fms:%s,args:%s' % (elapsed * 1000, sql, args))
+
+
+class PoolTimeoutError(Exception):
+    # 在acquire_timeout内没有拿到连接，由app转换成503
+    pass
+
+
+POOL_TIMEOUTS = Counter('blog_pool_acquire_timeouts_total', 'Connection acquisitions that timed out', ['pool'])
+
+
+class _PooledConnection(object):
+
+    def __init__(self, pool, conn):
+        self._pool = pool
+        self._conn = conn
+
+    def __enter__(self):
+        return self._conn
+
+    def __exit__(self, exc_type, exc, tb):
+        self._pool.release(self._conn)
+
+
+class Pool(object):
+    # 包装aiomysql连接池：统计使用中/空闲/等待数量，获取连接超时报错而不是无限排队
+    # adaptive为True时，并发上限limit根据等待时间在[minsize, maxsize]之间自动增减
+    def __init__(self, name, pool, minsize, maxsize, acquire_timeout=5, adaptive=False, grow_wait=0.02,
+                 adjust_interval=5):
+        self.name = name
+        self.pool = pool
+        self.minsize = max(minsize, 1)
+        self.maxsize = maxsize
+        self.limit = max(self.minsize, maxsize // 2) if adaptive else maxsize
+        self.acquire_timeout = acquire_timeout
+        self.adaptive = adaptive
+        self.grow_wait = grow_wait
+        self.adjust_interval = adjust_interval
+        self.in_use = 0
+        self._waiters = collections.deque()
+        # 本周期内的等待时间和使用峰值，用于调整limit
+        self._wait_total = 0.0
+        self._wait_count = 0
+        self._peak = 0
+        self._adjusted_at = time.time()
+
+    @property
+    def waiting(self):
+        return len(self._waiters)
+
+    @property
+    def idle(self):
+        return self.pool.freesize
+
+    async def _acquire_slot(self, timeout):
+        if self.in_use < self.limit and not self._waiters:
+            self.in_use += 1
+            return
+        fut = asyncio.get_event_loop().create_future()
+        self._waiters.append(fut)
+        try:
+            # 被唤醒时已经在_wakeup中占好了名额
+            await asyncio.wait_for(fut, timeout)
+        except asyncio.TimeoutError:
+            self._timeout()
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                self._release_slot()
+            raise
+        finally:
+            if fut in self._waiters:
+                self._waiters.remove(fut)
+
+    def _timeout(self):
+        POOL_TIMEOUTS.inc(1, self.name)
+        raise PoolTimeoutError('acquire connection from pool %s timeout' % self.name)
+
+    def _release_slot(self):
+        self.in_use -= 1
+        self._wakeup()
+
+    def _wakeup(self):
+        while self._waiters and self.in_use < self.limit:
+            fut = self._waiters.popleft()
+            if not fut.done():
+                self.in_use += 1
+                fut.set_result(None)
+
+    async def acquire(self):
+        # 返回连接的上下文管理器和等待连接的时间
+        # 排队和从aiomysql连接池取连接共用一个超时时间
+        start = time.perf_counter()
+        deadline = start + self.acquire_timeout
+        await self._acquire_slot(self.acquire_timeout)
+        try:
+            conn = await asyncio.wait_for(self.pool.acquire(), max(deadline - time.perf_counter(), 0))
+        except asyncio.TimeoutError:
+            self._release_slot()
+            self._timeout()
+        except BaseException:
+            self._release_slot()
+            raise
+        wait = time.perf_counter() - start
+        self._peak = max(self._peak, self.in_use)
+        self._wait_total += wait
+        self._wait_count += 1
+        if self.adaptive:
+            self._adjust()
+        return _PooledConnection(self, conn), wait
+
+    def release(self, conn):
+        self.pool.release(conn)
+        self._release_slot()
+
+    def _adjust(self):
+        now = time.time()
+        if now - self._adjusted_at < self.adjust_interval:
+            return
+        avg_wait = self._wait_total / self._wait_count if self._wait_count else 0.0
+        if avg_wait > self.grow_wait and self.limit < self.maxsize:
+            self.limit += 1
+            logging.info('grow pool %s limit to %s (avg wait %.1fms)' % (self.name, self.limit, avg_wait * 1000))
+            self._wakeup()
+        elif avg_wait < self.grow_wait / 10 and self._peak < self.limit - 1 and self.limit > self.minsize:
+            self.limit -= 1
+            logging.info('shrink pool %s limit to %s' % (self.name, self.limit))
+        self._wait_total = 0.0
+        self._wait_count = 0
+        self._peak = self.in_use
+        self._adjusted_at = now
+
+
+def _pool_stats():
+    stats = dict()
+    for pool in _pools:
+        stats[(pool.name, 'in_use')] = pool.in_use
+        stats[(pool.name, 'idle')] = pool.idle
+        stats[(pool.name, 'waiting')] = pool.waiting
+        stats[(pool.name, 'limit')] = pool.limit
+    return stats
+
+
+_pools = []
+POOL_CONNECTIONS = Gauge('blog_pool_connections', 'Connection pool state', ['pool', 'state'], callback=_pool_stats)
+
+
+class Replica(object):
+
+    def __init__(self, name, pool):
+        self.name = name
+        self.pool = pool
+        self.down_until = 0
+
+    @property
+    def healthy(self):
+        return self.down_until <= time.time()
+
+    @property
+    def busy(self):
+        return self.pool.in_use + self.pool.waiting
+
+    def eject(self, seconds):
+        if self.healthy:
+            logging.warning('eject replica %s for %ss' % (self.name, seconds))
+        self.down_until = time.time() + seconds
+
+    def readmit(self):
+        if not self.healthy:
+            logging.info('readmit replica %s' % self.name)
+        self.down_until = 0
+
+
+_replicas = []
+_replica_options = dict(strategy='round_robin', eject_seconds=30, health_check_interval=10)
+_round_robin = itertools.count()
+
+
+async def _create_pool(loop, name, kwargs, minsize):
+    pool = await aiomysql.create_pool(
         loop=loop,
         host=kwargs.get('host', 'localhost'),
         port=kwargs.get('port', 3306),
@@ -18,40 +287,290 @@ async def create_pool(loop, **kwargs):
         autocommit=kwargs.get('autocommit', True),
         charset=kwargs.get('charset', 'utf8'),
         maxsize=kwargs.get('maxsize', 10),
-        minsize=kwargs.get('minsize', 1)
+        minsize=minsize
     )
+    pool = Pool(name, pool, minsize, kwargs.get('maxsize', 10), acquire_timeout=kwargs.get('acquire_timeout', 5),
+                adaptive=kwargs.get('adaptive_pool', False), grow_wait=kwargs.get('pool_grow_wait_ms', 20) / 1000)
+    _pools.append(pool)
+    return pool
 
 
-async def select(sql, args, size=None):
-    log(sql, args)
+async def create_pool(loop, **kwargs):
+    log('create database connection pool...')
+    _count_cache.ttl = kwargs.get('count_cache_ttl', 60)
+    _slow_query_seconds[0] = kwargs.get('slow_query_ms', 500) / 1000
     global __pool
-    with (await __pool) as conn:
+    del _pools[:]
+    __pool = await _create_pool(loop, 'primary', kwargs, kwargs.get('minsize', 1))
+    _replica_options['strategy'] = kwargs.get('replica_strategy', 'round_robin')
+    _replica_options['eject_seconds'] = kwargs.get('replica_eject_seconds', 30)
+    _replica_options['health_check_interval'] = kwargs.get('health_check_interval', 10)
+    del _replicas[:]
+    for replica in kwargs.get('replicas', ()):
+        # 副本只需要配置与主库不同的项，如host/port
+        options = dict(kwargs, **replica)
+        name = '%s:%s' % (options.get('host', 'localhost'), options.get('port', 3306))
+        log('create replica connection pool %s...' % name)
+        # minsize=0：副本暂时不可用时不影响启动，由健康检查负责恢复
+        _replicas.append(Replica(name, await _create_pool(loop, name, options, 0)))
+    if _replicas:
+        loop.create_task(check_replicas())
+
+
+async def check_replicas():
+    while True:
+        await asyncio.sleep(_replica_options['health_check_interval'])
+        for replica in _replicas:
+            try:
+                cm, _ = await replica.pool.acquire()
+                with cm as conn:
+                    cur = await conn.cursor()
+                    await cur.execute('select 1')
+                    await cur.close()
+                replica.readmit()
+            except PoolTimeoutError:
+                # 副本繁忙不代表不可用
+                pass
+            except _CONNECTION_ERRORS as e:
+                logging.warning('replica %s health check failed: %s' % (replica.name, e))
+                replica.eject(_replica_options['eject_seconds'])
+            except Exception as e:
+                # 其他错误也不能让健康检查任务退出，否则被剔除的副本永远不会恢复
+                logging.exception('replica %s health check error: %s' % (replica.name, e))
+                replica.eject(_replica_options['eject_seconds'])
+
+
+def choose_replica():
+    if not _replicas or read_primary.get():
+        return None
+    candidates = [r for r in _replicas if r.healthy]
+    if not candidates:
+        return None
+    if _replica_options['strategy'] == 'least_busy':
+        return min(candidates, key=lambda r: r.busy)
+    return candidates[next(_round_robin) % len(candidates)]
+
+
+async def _select(pool, sql, args, size):
+    cm, wait = await pool.acquire()
+    with cm as conn:
+        start = time.perf_counter()
         cur = await conn.cursor(aiomysql.DictCursor)
-        await cur.execute(sql.replace('?', '%s'), args or ())
+        await cur.execute(driver_sql(sql), args or ())
         if size:
             rs = await cur.fetchmany(size)
         else:
             rs = await cur.fetchall()
         await cur.close()
+        record_query('select', sql, args, time.perf_counter() - start, wait, len(rs))
         logging.info('rows returned:%s' % len(rs))
         return rs
 
 
+async def select(sql, args, size=None):
+    log(sql, args)
+    global __pool
+    replica = choose_replica()
+    if replica is not None:
+        try:
+            return await _select(replica.pool, sql, args, size)
+        except PoolTimeoutError:
+            logging.warning('replica %s is busy, select on primary' % replica.name)
+        except _CONNECTION_ERRORS as e:
+            logging.warning('select on replica %s failed: %s' % (replica.name, e))
+            replica.eject(_replica_options['eject_seconds'])
+    # 事务中choose_replica返回None，使用事务的连接
+    return await _select(_transaction.get() or __pool, sql, args, size)
+
+
 async def execute(sql, args):
     log(sql, args)
     global __pool
-    with (await __pool) as conn:
+    read_primary.set(True)
+    cm, wait = await (_transaction.get() or __pool).acquire()
+    with cm as conn:
+        start = time.perf_counter()
         try:
             cur = await conn.cursor()
             # args中有None对象，执行sql时类型不识别报错，如何处理？
-            await cur.execute(sql.replace('?', '%s'), args or ())
+            await cur.execute(driver_sql(sql), args or ())
             affected = cur.rowcount
             await cur.close()
         except BaseException as e:
             raise
+        record_query('execute', sql, args, time.perf_counter() - start, wait, affected)
+        return affected
+
+
+async def select_iter(sql, args, batch_size=100):
+    # 使用非缓冲的服务端游标，每次只从连接读取batch_size行
+    if _transaction.get() is not None:
+        # 事务中只有一个连接，服务端游标会一直占用它，循环体中的其他语句就无法执行；
+        # 因此一次取完结果（释放连接）后再分批返回
+        rs = await select(sql, args)
+        for i in range(0, len(rs), batch_size):
+            yield rs[i:i + batch_size]
+        return
+    log(sql, args)
+    global __pool
+    replica = choose_replica()
+    pool = replica.pool if replica is not None else __pool
+    cm, wait = await pool.acquire()
+    with cm as conn:
+        # 只统计数据库耗时，不包括调用方处理每批数据的时间
+        elapsed = 0.0
+        rows = 0
+        start = time.perf_counter()
+        cur = await conn.cursor(aiomysql.SSDictCursor)
+        try:
+            await cur.execute(driver_sql(sql), args or ())
+            while True:
+                rs = await cur.fetchmany(batch_size)
+                elapsed += time.perf_counter() - start
+                if not rs:
+                    break
+                rows += len(rs)
+                yield rs
+                start = time.perf_counter()
+        finally:
+            # 提前退出时close会读完剩余结果，连接才能放回连接池
+            await cur.close()
+            record_query('select_iter', sql, args, elapsed, wait, rows)
+
+
+async def executemany(sql, args_list):
+    log(sql, '%s rows' % len(args_list))
+    global __pool
+    read_primary.set(True)
+    cm, wait = await (_transaction.get() or __pool).acquire()
+    with cm as conn:
+        start = time.perf_counter()
+        cur = await conn.cursor()
+        # insert语句会被驱动合并成一条多行insert
+        await cur.executemany(driver_sql(sql), args_list)
+        affected = cur.rowcount
+        await cur.close()
+        record_query('executemany', sql, '%s rows' % len(args_list), time.perf_counter() - start, wait, affected)
         return affected
 
 
+def primary_pool():
+    global __pool
+    return __pool
+
+
+class _PinnedConnection(object):
+    # 事务连接的上下文管理器：退出时只释放事务内的锁，连接在事务结束时才放回连接池
+
+    def __init__(self, lock, conn):
+        self._lock = lock
+        self._conn = conn
+
+    def __enter__(self):
+        return self._conn
+
+    def __exit__(self, exc_type, exc, tb):
+        self._lock.release()
+
+
+class Transaction(object):
+    # 块内的select/execute都使用同一个主库连接，正常退出时提交，出现异常时回滚
+    # 块内Model的save/update/remove先放进工作单元，执行其他语句前和提交前按顺序批量写入：
+    # 相邻的同一语句合并成一次executemany（insert由驱动合并成一条多行insert）
+    def __init__(self, outer=None):
+        self.outer = outer
+        self.conn = None
+        self.counts = []
+        self._work = []
+        self._cm = None
+        self._token = None
+        self._lock = asyncio.Lock()
+
+    async def __aenter__(self):
+        if self.outer is not None:
+            # 嵌套的transaction()加入外层事务
+            return self.outer
+        self._cm, wait = await primary_pool().acquire()
+        self.conn = self._cm.__enter__()
+        try:
+            start = time.perf_counter()
+            await self.conn.begin()
+            record_query('begin', 'begin', (), time.perf_counter() - start, wait, 0)
+        except BaseException:
+            self._cm.__exit__(None, None, None)
+            raise
+        read_primary.set(True)
+        self._token = _transaction.set(self)
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        if self.outer is not None:
+            return False
+        try:
+            if exc_type is None:
+                try:
+                    async with self._lock:
+                        await self._flush()
+                        start = time.perf_counter()
+                        await self.conn.commit()
+                        record_query('commit', 'commit', (), time.perf_counter() - start, 0.0, 0)
+                except BaseException:
+                    await self._rollback()
+                    raise
+            else:
+                await self._rollback()
+        finally:
+            _transaction.reset(self._token)
+            self._cm.__exit__(None, None, None)
+        if exc_type is None:
+            for table, delta in self.counts:
+                adjust_counts(table, delta)
+        return False
+
+    async def _rollback(self):
+        self._work = []
+        try:
+            await self.conn.rollback()
+        except Exception as e:
+            # 连接状态未知，关闭后连接池不会再使用它
+            logging.warning('rollback failed: %s' % e)
+            self.conn.close()
+
+    async def acquire(self):
+        # 与Pool.acquire相同的返回值；同一事务内并发的语句依次执行
+        await self._lock.acquire()
+        try:
+            await self._flush()
+        except BaseException:
+            self._lock.release()
+            raise
+        return _PinnedConnection(self._lock, self.conn), 0.0
+
+    def add(self, sql, table, sign, args):
+        # sign：insert为1，delete为-1，update为0，用于调整行数缓存
+        self._work.append((sql, table, sign, args))
+
+    async def _flush(self):
+        work, self._work = self._work, []
+        for (sql, table, sign), group in itertools.groupby(work, key=lambda w: w[:3]):
+            args_list = [w[3] for w in group]
+            log(sql, '%s rows' % len(args_list))
+            start = time.perf_counter()
+            cur = await self.conn.cursor()
+            await cur.executemany(driver_sql(sql), args_list)
+            affected = cur.rowcount
+            await cur.close()
+            record_query('flush', sql, '%s rows' % len(args_list), time.perf_counter() - start, 0.0, affected)
+            if affected != len(args_list):
+                logging.warning('affected rows %s, expected %s' % (affected, len(args_list)))
+            adjust_counts(table, sign * affected)
+
+
+def transaction():
+    # async with orm.transaction(): ...
+    return Transaction(_transaction.get())
+
+
 class Field(object):
 
     def __init__(self, name, column_type, primary_key, default):
@@ -59,6 +578,8 @@ class Field(object):
         self.column_type = column_type
         self.primary_key = primary_key
         self.default = default
+        # detail字段只在find时读取，findAll/iterate的列表查询不读取
+        self.detail = False
 
     def __str__(self):
         return '<%s, %s:%s>' % (self.__class__.__name__, self.column_type, self.name)
@@ -90,8 +611,63 @@ class FloatField(Field):
 
 class TextField(Field):
 
-    def __init__(self, name=None, default=None):
+    def __init__(self, name=None, default=None, detail=False):
         super().__init__(name=name, column_type='text', primary_key=False, default=default)
+        self.detail = detail
+
+
+# 模型类名 -> 模型类，用于解析关联关系中以字符串声明的模型
+_models = dict()
+
+
+class Relation(object):
+
+    def __init__(self, model, key, orderBy=None, exclude=()):
+        self.model = model
+        self.key = key
+        self.orderBy = orderBy
+        self.exclude = exclude
+
+    @property
+    def target(self):
+        return _models[self.model]
+
+    async def fetch(self, column, values):
+        values = list(values)
+        if not values:
+            return []
+        where = '`%s` in (%s)' % (column, create_args_placeholder_str(len(values)))
+        rs = await self.target.findAll(where, values, orderBy=self.orderBy)
+        for r in rs:
+            for k in self.exclude:
+                r.pop(k, None)
+        return rs
+
+    def __str__(self):
+        return '<%s, %s:%s>' % (self.__class__.__name__, self.model, self.key)
+
+
+class BelongsTo(Relation):
+    # 本表key字段指向关联表主键，预加载结果为单个对象或None
+
+    async def load(self, name, models):
+        keys = set(m.getValue(self.key) for m in models) - {None}
+        rs = await self.fetch(self.target.__primary_key__, keys)
+        related = dict((r.getValue(self.target.__primary_key__), r) for r in rs)
+        for m in models:
+            setattr(m, name, related.get(m.getValue(self.key)))
+
+
+class HasMany(Relation):
+    # 关联表key字段指向本表主键，预加载结果为列表
+
+    async def load(self, name, models):
+        keys = set(m.getValue(m.__primary_key__) for m in models) - {None}
+        related = dict((k, []) for k in keys)
+        for r in await self.fetch(self.key, keys):
+            related[r.getValue(self.key)].append(r)
+        for m in models:
+            setattr(m, name, related.get(m.getValue(m.__primary_key__), []))
 
 
 def create_args_placeholder_str(num):
@@ -113,10 +689,13 @@ class ModelMetaclass(type):
 
         # 提取定义的field和主键名
         mappings = dict()
+        relations = dict()
         fields = []
         primarykey = None
         for k, v in attrs.items():
-            if isinstance(v, Field):
+            if isinstance(v, Relation):
+                relations[k] = v
+            elif isinstance(v, Field):
                 mappings[k] = v
                 if v.primary_key:
                     if primarykey:
@@ -128,16 +707,24 @@ class ModelMetaclass(type):
             raise RuntimeError('no primarykey in model')
         for k in mappings:
             attrs.pop(k)
+        for k in relations:
+            attrs.pop(k)
         common_fields = list(map(lambda f: '`%s`' % (mappings.get(f).name or f), fields))
         attrs['__table__'] = tablename
         attrs['__mappings__'] = mappings
         attrs['__primary_key__'] = primarykey
         attrs['__fields__'] = fields
-        attrs['__select__'] = 'select `%s`, %s from `%s`' % (primarykey, ', '.join(common_fields), tablename)
+        attrs['__relations__'] = relations
+        list_fields = ['`%s`' % (mappings.get(f).name or f) for f in fields if not mappings.get(f).detail]
+        attrs['__select__'] = 'select `%s`, %s from `%s`' % (primarykey, ', '.join(list_fields), tablename)
         attrs['__insert__'] = 'insert into `%s` (%s, `%s`) values (%s)' % (tablename, ', '.join(common_fields), primarykey, create_args_placeholder_str(len(fields)+1))
         attrs['__update__'] = 'update `%s` set %s where `%s`=?' % (tablename, ', '.join(list(map(lambda f: '`%s`=?' % (mappings.get(f).name or f), fields))), primarykey)
         attrs['__delete__'] = 'delete from `%s` where `%s`=?' % (tablename, primarykey)
-        return type.__new__(cls, name, bases, attrs)
+        attrs['__find__'] = 'select `%s`, %s from `%s` where `%s`=?' % (primarykey, ', '.join(common_fields), tablename, primarykey)
+        model = type.__new__(cls, name, bases, attrs)
+        model.__record__ = make_record_class(model)
+        _models[name] = model
+        return model
 
 
 class Model(dict, metaclass=ModelMetaclass):
@@ -168,76 +755,228 @@ class Model(dict, metaclass=ModelMetaclass):
         return value
 
     @classmethod
-    # find objects by where clause
-    async def findAll(cls, where=None, args=None, **kwargs):
+    def compileSelect(cls, where=None, orderBy=None, limit=None, seek=None):
+        # 按(模型, where, orderBy, limit形式, seek方向)缓存拼好的sql，limit为参数个数0/1/2
+        key = (cls.__name__, where, orderBy, limit, seek)
+        sql = _compiled_sql.get(key)
+        if sql is not None:
+            return sql
         sql = [cls.__select__]
+        if seek is not None:
+            op = '<' if seek == 'after' else '>'
+            cond = '(`created_at`%s? or (`created_at`=? and `%s`%s?))' % (op, cls.__primary_key__, op)
+            where = '(%s) and %s' % (where, cond) if where else cond
+            orderBy = '`created_at` %s, `%s` %s' % ('desc' if seek == 'after' else 'asc', cls.__primary_key__,
+                                                   'desc' if seek == 'after' else 'asc')
         if where:
             sql.append('where')
             sql.append(where)
-        if args is None:
-            args = []
-        orderBy = kwargs.get('orderBy', None)
         if orderBy:
             sql.append('order by')
             sql.append(orderBy)
-        limit = kwargs.get('limit', None)
-        if limit is not None:
+        if limit:
             sql.append('limit')
-            if isinstance(limit, int):
-                sql.append('?')
-                args.append(limit)
-            elif isinstance(limit, tuple) and len(limit) == 2:
-                sql.append('?, ?')
-                args.extend(limit)
-            else:
-                raise ValueError('limit value is invalid')
-        rs = await select(' '.join(sql), args)
-        return [cls(**r) for r in rs]
+            sql.append(create_args_placeholder_str(limit))
+        sql = ' '.join(sql)
+        _compiled_sql.set(key, sql)
+        return sql
+
+    @classmethod
+    # find objects by where clause
+    # after/before传入(created_at, id)游标时按(created_at, id)做seek分页，不再使用offset
+    async def findAll(cls, where=None, args=None, **kwargs):
+        if args is None:
+            args = []
+        else:
+            args = list(args)
+        after = kwargs.get('after', None)
+        before = kwargs.get('before', None)
+        seek = None
+        if after is not None or before is not None:
+            if after is not None and before is not None:
+                raise ValueError('after and before can not be used together')
+            seek = 'after' if after is not None else 'before'
+            created_at, pk = after if after is not None else before
+            args.extend([created_at, created_at, pk])
+        limit = kwargs.get('limit', None)
+        if limit is None:
+            shape = 0
+        elif isinstance(limit, int):
+            shape = 1
+            args.append(limit)
+        elif isinstance(limit, tuple) and len(limit) == 2:
+            shape = 2
+            args.extend(limit)
+        else:
+            raise ValueError('limit value is invalid')
+        sql = cls.compileSelect(where, kwargs.get('orderBy', None), shape, seek)
+        rs = await select(sql, args)
+        if before is not None:
+            # 向前翻页时按升序取数，返回前恢复成降序
+            rs = list(reversed(rs))
+        # compact=True时返回__slots__实现的Record对象，占用内存更少，但json编码比Model慢，只用于模板渲染等
+        factory = cls.__record__ if kwargs.get('compact', False) else cls
+        models = [factory(**r) for r in rs]
+        prefetch = kwargs.get('prefetch', None)
+        if prefetch and models:
+            await cls.prefetch(models, prefetch)
+        return models
+
+    @classmethod
+    async def prefetch(cls, models, names):
+        # 每个关联关系只执行一次in查询，结果以关联名保存在对象上
+        for name in names:
+            relation = cls.__relations__.get(name)
+            if relation is None:
+                raise ValueError('no relation %s in model %s' % (name, cls.__name__))
+            await relation.load(name, models)
+
+    @classmethod
+    async def iterate(cls, where=None, args=None, batch_size=100, **kwargs):
+        # async for逐个返回对象，内存中最多只保留batch_size行
+        factory = cls.__record__ if kwargs.get('compact', False) else cls
+        sql = cls.compileSelect(where, kwargs.get('orderBy', None))
+        async for rs in select_iter(sql, args, batch_size):
+            for r in rs:
+                yield factory(**r)
 
     @classmethod
     async def findNumber(cls, selectfield, where=None, args=None):
         # sql语句执行出错，没有按预期返回，导致页面返回None，如何处理这种异常情况？
-        sql = ['select %s _num_ from %s' % (selectfield, cls.__table__)]
-        if where:
-            sql.append('where')
-            sql.append(where)
-        rs = await select(' '.join(sql), args, 1)
-        if len(rs) == 0:
-            return 0
-        return rs[0]['_num_']
+        key = (cls.__table__, selectfield, where or None, tuple(args or ()))
+        num = _count_cache.get(key)
+        if num is not None:
+            return num
+        sql_key = ('findNumber',) + key[:3]
+        sql = _compiled_sql.get(sql_key)
+        if sql is None:
+            sql = 'select %s _num_ from `%s`' % (selectfield, cls.__table__)
+            if where:
+                sql = '%s where %s' % (sql, where)
+            _compiled_sql.set(sql_key, sql)
+        rs = await select(sql, args, 1)
+        num = rs[0]['_num_'] if len(rs) else 0
+        if num is not None:
+            _count_cache.set(key, num)
+        return num
 
     @classmethod
     async def find(cls, pk):
         # find object by primary_key
-        rs = await select('%s where `%s`=?' % (cls.__select__, cls.__primary_key__), [pk], 1)
+        rs = await select(cls.__find__, [pk], 1)
         if len(rs) == 0:
             return None
         return cls(**rs[0])
 
+    @classmethod
+    async def saveAll(cls, models):
+        if not models:
+            return 0
+        args_list = []
+        for m in models:
+            args = list(map(m.getValueOrDefault, cls.__fields__))
+            args.append(m.getValueOrDefault(cls.__primary_key__))
+            args_list.append(args)
+        affected = await executemany(cls.__insert__, args_list)
+        if affected != len(models):
+            logging.warning('affected rows %s, expected %s' % (affected, len(models)))
+        adjust_counts(cls.__table__, affected)
+        return affected
+
+    @classmethod
+    async def updateWhere(cls, set, where, args=None):
+        # set和where中的参数按顺序放在args里，如updateWhere('`name`=?', '`id`=?', [name, id])
+        affected = await execute('update `%s` set %s where %s' % (cls.__table__, set, where), args)
+        adjust_counts(cls.__table__, 0)
+        return affected
+
+    @classmethod
+    async def removeWhere(cls, where, args=None):
+        affected = await execute('delete from `%s` where %s' % (cls.__table__, where), args)
+        adjust_counts(cls.__table__, -affected)
+        return affected
+
     async def save(self):
         args = list(map(self.getValueOrDefault, self.__fields__))
         args.append(self.getValueOrDefault(self.__primary_key__))
+        tx = _transaction.get()
+        if tx is not None:
+            tx.add(self.__insert__, self.__table__, 1, args)
+            return
         affected = await execute(self.__insert__, args)
         if affected != 1:
             logging.warning('affected row is not 1')
+        adjust_counts(self.__table__, affected)
 
     async def update(self):
         args = list(map(self.getValueOrDefault, self.__fields__))
         args.append(self.getValueOrDefault(self.__primary_key__))
+        tx = _transaction.get()
+        if tx is not None:
+            tx.add(self.__update__, self.__table__, 0, args)
+            return
         affected = await execute(self.__update__, args)
         if affected != 1:
             logging.warning('affected row is not 1')
+        adjust_counts(self.__table__, 0)
 
     async def remove(self):
         args = [self.getValueOrDefault(self.__primary_key__)]
+        tx = _transaction.get()
+        if tx is not None:
+            tx.add(self.__delete__, self.__table__, -1, args)
+            return
         affected = await execute(self.__delete__, args)
         if affected != 1:
             logging.warning('affected row is not 1')
+        adjust_counts(self.__table__, -affected)
+
 
+class Record(object):
+    # Model的紧凑表示：字段保存在__slots__中而不是dict里，用于列表页和导出等大批量读取
+    # 由ModelMetaclass为每个模型生成子类，接口与Model一致
+    __slots__ = ()
 
+    def __init__(self, **kwargs):
+        for k, v in kwargs.items():
+            setattr(self, k, v)
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        setattr(self, key, value)
+
+    def get(self, key, default=None):
+        return getattr(self, key, default)
+
+    def pop(self, key, default=None):
+        value = getattr(self, key, default)
+        if hasattr(self, key):
+            delattr(self, key)
+        return value
 
+    def keys(self):
+        return [k for k in self.__slots__ if hasattr(self, k)]
 
+    def _asdict(self):
+        return dict((k, getattr(self, k)) for k in self.__slots__ if hasattr(self, k))
 
+    def __repr__(self):
+        return '%s(%s)' % (self.__class__.__name__, ', '.join('%s=%r' % kv for kv in self._asdict().items()))
 
+    getValue = Model.getValue
+    getValueOrDefault = Model.getValueOrDefault
+    save = Model.save
+    update = Model.update
+    remove = Model.remove
 
 
+def make_record_class(model):
+    attrs = dict((k, getattr(model, k)) for k in ('__table__', '__mappings__', '__primary_key__', '__fields__',
+                                                  '__relations__', '__insert__', '__update__', '__delete__'))
+    attrs['__slots__'] = tuple([model.__primary_key__] + model.__fields__ + list(model.__relations__))
+    return type('%sRecord' % model.__name__, (Record,), attrs)
@@ -0,0 +1,354 @@
+import os, re, math, time, gzip, json, heapq, fcntl, asyncio, logging
+from collections import Counter
+from orm import select, create_args_placeholder_str
+from models import Blog, Comment
+
+'''
+日志全文搜索：进程内倒排索引 + BM25排序
+一篇日志是一个文档，标题、摘要、正文和它的全部评论都计入该文档；中文按相邻两字切分（bigram）
+索引以gzip压缩的json保存到磁盘，启动时直接加载；多进程时各worker在保存前后通过文件锁和修改时间同步
+启动时与数据库比对日志和评论数，补上没来得及保存的修改；日志内容的修改无法比对，需要时执行python search.py rebuild重建
+'''
+
+_TOKEN_RE = re.compile(r'[0-9a-z]+|[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff]+')
+_MAX_WORD_LENGTH = 32
+# 字段权重：标题命中比正文命中更相关
+FIELD_WEIGHTS = (('name', 3), ('summary', 2), ('content', 1))
+FORMAT_VERSION = 2
+
+
+def tokenize(text):
+    tokens = []
+    for m in _TOKEN_RE.finditer((text or '').lower()):
+        word = m.group()
+        if word[0] < '\u3040':
+            if len(word) <= _MAX_WORD_LENGTH:
+                tokens.append(word)
+        elif len(word) == 1:
+            tokens.append(word)
+        else:
+            tokens.extend(word[i:i + 2] for i in range(len(word) - 1))
+    return tokens
+
+
+def blog_terms(blog):
+    counts = Counter()
+    for field, weight in FIELD_WEIGHTS:
+        for token in tokenize(blog.get(field)):
+            counts[token] += weight
+    return counts
+
+
+def comment_terms(comment):
+    return Counter(tokenize(comment.content))
+
+
+class SearchIndex(object):
+    # 正排：日志id -> [日志字段词频, 评论词频, 评论数]，倒排：词 -> {日志id: 词频}
+    # 修改在保存到文件之前记在_pending中，加载其他worker保存的文件后重新应用
+    def __init__(self, path, k1=1.2, b=0.75, save_delay=5, check_interval=2):
+        self.path = path
+        self.k1 = k1
+        self.b = b
+        self.save_delay = save_delay
+        self.check_interval = check_interval
+        self._docs = dict()
+        self._postings = dict()
+        self._lengths = dict()
+        self._total_length = 0
+        self._pending = []
+        self._file_id = None
+        self._checked_at = 0
+        self._save_handle = None
+
+    def __len__(self):
+        return len(self._docs)
+
+    def _add(self, doc_id, counts, sign=1):
+        for term, tf in counts.items():
+            postings = self._postings.setdefault(term, dict())
+            value = postings.get(doc_id, 0) + sign * tf
+            if value > 0:
+                postings[doc_id] = value
+            else:
+                postings.pop(doc_id, None)
+                if not postings:
+                    del self._postings[term]
+        delta = sign * sum(counts.values())
+        self._lengths[doc_id] = self._lengths.get(doc_id, 0) + delta
+        self._total_length += delta
+
+    def _drop(self, doc_id):
+        doc = self._docs.pop(doc_id, None)
+        if doc is None:
+            return
+        self._add(doc_id, doc[0], -1)
+        self._add(doc_id, doc[1], -1)
+        del self._lengths[doc_id]
+
+    def _apply(self, op):
+        kind, doc_id = op[0], op[1]
+        if kind == 'drop':
+            self._drop(doc_id)
+            return
+        doc = self._docs.get(doc_id)
+        if kind == 'blog':
+            if doc is None:
+                doc = self._docs[doc_id] = [Counter(), Counter(), 0]
+            self._add(doc_id, doc[0], -1)
+            doc[0] = Counter(op[2])
+            self._add(doc_id, doc[0])
+        elif doc is not None:
+            # 评论：按词频增减，所属日志已删除时忽略
+            counts, sign = op[2], op[3]
+            if sign > 0:
+                doc[1].update(counts)
+            else:
+                doc[1].subtract(counts)
+            doc[1] = +doc[1]
+            doc[2] += sign
+            self._add(doc_id, counts, sign)
+
+    def _update(self, op):
+        self._apply(op)
+        self._pending.append(op)
+        self._schedule_save()
+
+    def add_blog(self, blog):
+        # 新建和修改日志都调用，只替换日志字段部分，评论部分保留
+        self._update(('blog', blog.id, blog_terms(blog)))
+
+    def remove_blog(self, blog_id):
+        self._update(('drop', blog_id))
+
+    def add_comment(self, comment):
+        self._update(('comment', comment.blog_id, comment_terms(comment), 1))
+
+    def remove_comment(self, comment):
+        if comment.blog_id in self._docs:
+            self._update(('comment', comment.blog_id, comment_terms(comment), -1))
+
+    def match(self, query):
+        # 返回同时包含全部查询词的日志及BM25得分：{日志id: 得分}
+        terms = set(tokenize(query))
+        if not terms or not self._docs:
+            return dict()
+        postings = []
+        for term in terms:
+            p = self._postings.get(term)
+            if not p:
+                return dict()
+            postings.append(p)
+        postings.sort(key=len)
+        n = len(self._docs)
+        avgdl = self._total_length / n or 1
+        k1, b = self.k1, self.b
+        scores = dict()
+        for doc_id in postings[0]:
+            if all(doc_id in p for p in postings[1:]):
+                scores[doc_id] = 0.0
+        for p in postings:
+            idf = math.log(1 + (n - len(p) + 0.5) / (len(p) + 0.5))
+            for doc_id in scores:
+                tf = p[doc_id]
+                scores[doc_id] += idf * tf * (k1 + 1) / (tf + k1 * (1 - b + b * self._lengths[doc_id] / avgdl))
+        return scores
+
+    @staticmethod
+    def rank(scores, offset, limit):
+        top = heapq.nlargest(offset + limit, scores.items(), key=lambda item: item[1])
+        return [doc_id for doc_id, _ in top[offset:]]
+
+    # 持久化
+
+    def _file_ident(self):
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return st.st_ino, st.st_mtime_ns, st.st_size
+
+    def _read(self):
+        with gzip.open(self.path, 'rt', encoding='utf-8') as f:
+            data = json.load(f)
+        if data.get('version') != FORMAT_VERSION:
+            raise ValueError('unsupported search index version: %s' % data.get('version'))
+        return data['docs']
+
+    def _write(self, docs):
+        tmp = '%s.%s.tmp' % (self.path, os.getpid())
+        with gzip.open(tmp, 'wt', encoding='utf-8', compresslevel=6) as f:
+            json.dump(dict(version=FORMAT_VERSION, docs=docs), f, ensure_ascii=False, separators=(',', ':'))
+        os.replace(tmp, self.path)
+
+    def _dump(self):
+        return dict((doc_id, [dict(doc[0]), dict(doc[1]), doc[2]]) for doc_id, doc in self._docs.items())
+
+    def _load(self, docs, file_id):
+        # 用文件内容替换内存中的索引，再重新应用本进程尚未保存的修改
+        self._docs = dict()
+        self._postings = dict()
+        self._lengths = dict()
+        self._total_length = 0
+        for doc_id, (blog_counts, comment_counts, comment_number) in docs.items():
+            doc = self._docs[doc_id] = [Counter(blog_counts), Counter(comment_counts), comment_number]
+            self._add(doc_id, doc[0])
+            self._add(doc_id, doc[1])
+        for op in self._pending:
+            self._apply(op)
+        self._file_id = file_id
+
+    def _lock(self):
+        f = open(self.path + '.lock', 'w')
+        fcntl.flock(f, fcntl.LOCK_EX)
+        return f
+
+    async def _run(self, func, *args):
+        return await asyncio.get_event_loop().run_in_executor(None, func, *args)
+
+    async def _sync_from_file(self):
+        # 文件被其他进程更新过时重新加载，返回False表示文件不存在
+        file_id = self._file_ident()
+        if file_id is None:
+            return False
+        if file_id != self._file_id:
+            start = time.perf_counter()
+            docs = await self._run(self._read)
+            self._load(docs, file_id)
+            logging.info('search index loaded %s blogs in %.1fms' % (len(self._docs), (time.perf_counter() - start) * 1000))
+        return True
+
+    async def refresh(self):
+        # 搜索前调用，最多每check_interval秒检查一次文件
+        now = time.time()
+        if now - self._checked_at < self.check_interval:
+            return
+        self._checked_at = now
+        try:
+            await self._sync_from_file()
+        except (OSError, ValueError) as e:
+            logging.warning('search index reload failed: %s' % e)
+
+    async def save(self):
+        if self._save_handle is not None:
+            self._save_handle.cancel()
+            self._save_handle = None
+        lock = await self._run(self._lock)
+        try:
+            await self._sync_from_file()
+            saved = len(self._pending)
+            await self._run(self._write, self._dump())
+            self._file_id = self._file_ident()
+            del self._pending[:saved]
+        finally:
+            lock.close()
+
+    def _schedule_save(self):
+        if self._save_handle is None:
+            loop = asyncio.get_event_loop()
+            self._save_handle = loop.call_later(self.save_delay, lambda: loop.create_task(self._save_later()))
+
+    async def _save_later(self):
+        self._save_handle = None
+        try:
+            await self.save()
+        except OSError as e:
+            logging.warning('search index save failed: %s' % e)
+            self._schedule_save()
+
+    async def rebuild(self):
+        # 从数据库重建全部索引
+        start = time.perf_counter()
+        self._pending = []
+        self._load(dict(), None)
+        async for blog in Blog.iterate(batch_size=500, compact=True):
+            self._apply(('blog', blog.id, blog_terms(blog)))
+        async for comment in Comment.iterate(batch_size=500, compact=True):
+            if comment.blog_id in self._docs:
+                self._apply(('comment', comment.blog_id, comment_terms(comment), 1))
+        logging.info('search index built %s blogs in %.1fms' % (len(self._docs), (time.perf_counter() - start) * 1000))
+
+    async def _reindex(self, blog_ids):
+        where = '`%%s` in (%s)' % create_args_placeholder_str(len(blog_ids))
+        for blog in await Blog.findAll(where % 'id', blog_ids, compact=True):
+            self._apply(('drop', blog.id))
+            self._apply(('blog', blog.id, blog_terms(blog)))
+        async for comment in Comment.iterate(where % 'blog_id', blog_ids, batch_size=500, compact=True):
+            self._apply(('comment', comment.blog_id, comment_terms(comment), 1))
+
+    async def catch_up(self, batch_size=100):
+        # 进程被强制结束时，延迟保存的修改会丢失：与数据库比对日志id和每篇日志的评论数，
+        # 删除已不存在的日志，重新索引新增的和评论数不一致的日志；返回是否有修改
+        start = time.perf_counter()
+        blog_ids = set(r['id'] for r in await select('select `id` from `blogs`', None))
+        rs = await select('select `blog_id`, count(*) _num_ from `comments` group by `blog_id`', None)
+        comment_numbers = dict((r['blog_id'], r['_num_']) for r in rs)
+        removed = [doc_id for doc_id in self._docs if doc_id not in blog_ids]
+        stale = [blog_id for blog_id in blog_ids
+                 if blog_id not in self._docs or self._docs[blog_id][2] != comment_numbers.get(blog_id, 0)]
+        for doc_id in removed:
+            self._apply(('drop', doc_id))
+        for i in range(0, len(stale), batch_size):
+            await self._reindex(stale[i:i + batch_size])
+        if removed or stale:
+            logging.info('search index caught up: %s removed, %s reindexed in %.1fms' % (
+                len(removed), len(stale), (time.perf_counter() - start) * 1000))
+        return bool(removed or stale)
+
+    async def open(self, rebuild=False):
+        # 启动时加载索引文件并与数据库比对，文件不存在、格式不对或rebuild为True时从数据库重建；
+        # 多个worker同时启动时只有一个进行比对或重建
+        lock = await self._run(self._lock)
+        try:
+            loaded = False
+            if not rebuild:
+                try:
+                    loaded = await self._sync_from_file()
+                except (OSError, ValueError) as e:
+                    logging.warning('search index load failed, rebuilding: %s' % e)
+            if loaded:
+                changed = await self.catch_up()
+            else:
+                await self.rebuild()
+                changed = True
+            if changed:
+                await self._run(self._write, self._dump())
+                self._file_id = self._file_ident()
+        finally:
+            lock.close()
+
+
+search_index = None
+
+
+def index_path(path):
+    if os.path.isabs(path):
+        return path
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), path)
+
+
+async def init_search(app, path='search_index.json.gz', **kw):
+    global search_index
+    search_index = SearchIndex(index_path(path), **kw)
+    await search_index.open()
+
+    async def close(app):
+        if search_index._pending:
+            await search_index.save()
+
+    app.on_cleanup.append(close)
+    return search_index
+
+
+if __name__ == '__main__':
+    # python search.py rebuild：从数据库重建索引文件，运行中的worker检查到文件更新后自动加载
+    import sys
+    from config import configs
+    from orm import create_pool
+    if sys.argv[1:] != ['rebuild']:
+        print('usage: python search.py rebuild')
+        sys.exit(1)
+    options = dict(configs.search)
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(create_pool(loop, **configs.db))
+    loop.run_until_complete(SearchIndex(index_path(options.pop('path')), **options).open(rebuild=True))
@@ -0,0 +1,55 @@
+import json
+from apis import Page, CursorPage
+from orm import Record
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+'''
+API响应的json编码：直接识别Page、CursorPage和Record，安装了orjson时优先使用orjson
+Model本身是dict子类，json和orjson都会按dict直接编码，不经过default钩子；
+Record要经过default钩子逐行转成dict，orjson下比Model慢得多，所以json接口返回Model，Record只用于模板和建索引
+'''
+
+
+def encode_page(p):
+    # 只输出公开属性，CursorPage内部的游标位置不输出
+    return dict((k, v) for k, v in p.__dict__.items() if not k.startswith('_'))
+
+
+_encoders = {
+    Page: encode_page,
+    CursorPage: encode_page
+}
+
+
+def default(o):
+    encoder = _encoders.get(type(o))
+    if encoder is not None:
+        return encoder(o)
+    if isinstance(o, Record):
+        return o._asdict()
+    if hasattr(o, '__dict__'):
+        return o.__dict__
+    raise TypeError('Object of type %s is not JSON serializable' % type(o).__name__)
+
+
+_encoder = json.JSONEncoder(ensure_ascii=False, separators=(',', ':'), default=default)
+
+
+def dumps(obj):
+    # 返回utf-8编码的bytes
+    if orjson is not None:
+        return orjson.dumps(obj, default=default)
+    return _encoder.encode(obj).encode('utf-8')
+
+
+async def aiter_dumps(items):
+    # 逐条编码列表元素，生成json数组的各个片段，用于流式输出；items为异步迭代器（如Model.iterate）
+    yield b'['
+    sep = b''
+    async for item in items:
+        yield sep + dumps(item)
+        sep = b','
+    yield b']'
@@ -0,0 +1,138 @@
+import asyncio, unittest
+import orm
+from models import Blog, Comment
+
+'''
+orm.transaction()的测试，使用记录语句的假连接，不需要MySQL：python -m unittest test_orm
+'''
+
+
+class FakeCursor(object):
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.rowcount = 0
+
+    async def execute(self, sql, args):
+        self.conn.log.append(('execute', sql.split()[0], args))
+        self.rowcount = 1
+        self._rows = self.conn.rows
+
+    async def executemany(self, sql, args_list):
+        self.conn.log.append(('executemany', sql.split()[0], len(args_list)))
+        self.rowcount = len(args_list)
+
+    async def fetchall(self):
+        return list(self._rows)
+
+    async def fetchmany(self, size):
+        rows, self._rows = self._rows[:size], self._rows[size:]
+        return rows
+
+    async def close(self):
+        pass
+
+
+class FakeConnection(object):
+
+    def __init__(self, log, rows):
+        self.log = log
+        self.rows = rows
+        self.closed = False
+
+    async def cursor(self, *args):
+        return FakeCursor(self)
+
+    async def begin(self):
+        self.log.append('begin')
+
+    async def commit(self):
+        self.log.append('commit')
+
+    async def rollback(self):
+        self.log.append('rollback')
+
+    def close(self):
+        self.closed = True
+
+
+class FakePool(object):
+    freesize = 1
+
+    def __init__(self, log, rows):
+        self.log = log
+        self.rows = rows
+
+    async def acquire(self):
+        return FakeConnection(self.log, self.rows)
+
+    def release(self, conn):
+        self.log.append('release')
+
+
+ROW_COUNT_KEY = ('comments', 'count(id)', None, ())
+
+
+class TransactionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.log = []
+        self.rows = [dict(id=str(i), name='blog %s' % i, created_at=float(i)) for i in range(5)]
+        self.pool = orm.Pool('primary', FakePool(self.log, self.rows), 1, 2)
+        self.saved_pool = getattr(orm, '__pool', None)
+        setattr(orm, '__pool', self.pool)
+        orm.invalidate_counts()
+        orm._count_cache.set(ROW_COUNT_KEY, 10)
+
+    def tearDown(self):
+        setattr(orm, '__pool', self.saved_pool)
+        orm.invalidate_counts()
+
+    def run_async(self, coro):
+        return asyncio.run(asyncio.wait_for(coro, 2))
+
+    def test_commit_batches_unit_of_work(self):
+        async def work():
+            async with orm.transaction():
+                for i in range(3):
+                    await Comment(blog_id='b', content='x').save()
+                await Blog.updateWhere('`comment_count`=`comment_count`+3', '`id`=?', ['b'])
+                async with orm.transaction():
+                    await Comment(id='z', blog_id='b', content='y').remove()
+                # 提交前不调整行数缓存
+                self.assertEqual(orm._count_cache.get(ROW_COUNT_KEY), 10)
+
+        self.run_async(work())
+        self.assertEqual(self.log, ['begin', ('executemany', 'insert', 3), ('execute', 'update', ['b']),
+                                    ('executemany', 'delete', 1), 'commit', 'release'])
+        self.assertEqual(orm._count_cache.get(ROW_COUNT_KEY), 12)
+        self.assertEqual(self.pool.in_use, 0)
+
+    def test_rollback_discards_work(self):
+        async def work():
+            async with orm.transaction():
+                await Comment(blog_id='b', content='x').save()
+                raise ValueError()
+
+        with self.assertRaises(ValueError):
+            self.run_async(work())
+        self.assertEqual(self.log, ['begin', 'rollback', 'release'])
+        self.assertEqual(orm._count_cache.get(ROW_COUNT_KEY), 10)
+        self.assertEqual(self.pool.in_use, 0)
+
+    def test_iterate_inside_transaction(self):
+        async def work():
+            found = []
+            async with orm.transaction():
+                async for blog in Blog.iterate(batch_size=2):
+                    found.append(await Blog.find(blog.id))
+            return found
+
+        found = self.run_async(work())
+        self.assertEqual(len(found), 5)
+        self.assertEqual(self.log[0], 'begin')
+        self.assertEqual(self.log[-2:], ['commit', 'release'])
+
+
+if __name__ == '__main__':
+    unittest.main()